@@ -0,0 +1,324 @@
+#!/usr/bin/python3
+'''
+module benchmark
+
+Measures the throughput of the scrubber on synthetic pages laid out like the
+old Math Emporium lessons. The first pass, each section parser, and the whole
+of scrub_file are timed separately, and the results can be saved as json and
+compared against an earlier run.
+'''
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import htmlscrubber
+from htmlparse import OutputBuffer, own_items
+from problem import DEFAULT_TEMPLATE_FILENAME
+import storage
+from tokenizers import tokenizer_name, tokenizer_names
+
+# Stages whose time is measured, in order
+STAGES = ['first_pass', 'discussion', 'examples', 'problem', 'scrub_file']
+
+
+class PageGenerator():
+    '''
+    Writes random pages with the p1/p2/p3 layout of the old lessons: content,
+    definition, and hint boxes in the discussion, an example table with
+    multi-part answers and hints, and lesson problems, all sprinkled with
+    colored spans (using the colors of the config) and images. Nested plain
+    divisions and spans are added up to the given depth.
+    '''
+
+    def __init__(self, config, seed=0, paragraphs=20, examples=5, parts=3,
+            problems=1, depth=3):
+        self._random = random.Random(seed)
+        self._colors = [key.upper() for key, value in
+            own_items(config, 'OLD_COLOR_NAMES')]
+        self._paragraphs = paragraphs
+        self._examples = examples
+        self._parts = parts
+        self._problems = problems
+        self._depth = depth
+        self._images = 0
+
+    def page(self):
+        lines = ['<html>', '<head><title>Lesson</title></head>', '<body>',
+            '<div id="wrapper">', '<div id="header">Header <b>text</b></div>']
+        lines.extend(self.discussion())
+        lines.extend(self.examples())
+        lines.extend(self.problems())
+        lines.extend(['</div>', '</body>', '</html>'])
+        return '\n'.join(lines) + '\n'
+
+    def words(self, count=12):
+        vocabulary = ['the', 'slope', 'of', 'a', 'line', 'is', 'equal', 'to',
+            'rise', 'over', 'run', 'solve', 'for', 'x', 'graph', 'point']
+        return ' '.join(self._random.choice(vocabulary) for i in range(count))
+
+    def image(self, attrs=''):
+        self._images += 1
+        return '<img{} src="img/eq{}.png">'.format(attrs, self._images % 50)
+
+    def styled(self):
+        '''
+        A line of text with inline markup, colors, and sometimes an image.
+        '''
+        color = self._random.choice(self._colors)
+        parts = [self.words(),
+            '<b>{}</b>'.format(self.words(2)),
+            '<span style="color:#{}">{}</span>'.format(color, self.words(3)),
+            '<i>{}</i>'.format(self.words(2)),
+            self.words(6)]
+        if self._random.random() < 0.3:
+            parts.append(self.image())
+        return ' '.join(parts)
+
+    def nested(self, depth):
+        if depth == 0:
+            return [self.styled()]
+        return ['<div>', self.styled()] + self.nested(depth - 1) + ['</div>']
+
+    def discussion(self):
+        lines = ['<div id="p1">', '<div class="contentbox">',
+            '<span class="title">{}</span>'.format(self.words(4))]
+        for i in range(self._paragraphs):
+            kind = i % 4
+            if kind == 0:
+                lines.extend(self.nested(self._depth))
+            elif kind == 1:
+                lines.extend(['<div class="beigebox">', self.styled(), '</div>'])
+            elif kind == 2:
+                lines.extend(['<div class="popuphelpp1">', self.words(),
+                    '<span class="flyouthelp">{}</span>'.format(self.words(2)),
+                    '</div>'])
+            else:
+                lines.extend(['<table><tbody><tr>',
+                    '<td>{}</td>'.format(self.styled()),
+                    '<td><a href="#">{}</a></td>'.format(self.words(2)),
+                    '</tr></tbody></table>'])
+        lines.extend(['</div>', '</div>'])
+        return lines
+
+    def examples(self):
+        lines = ['<div id="p2">', '<table class="example"><tbody>']
+        for example in range(1, self._examples + 1):
+            lines.extend(['<tr><td class="leftcell">{}</td>'.format(self.styled()),
+                '<td class="exanswerbox">',
+                '<span class="questionstatement">{}</span>'.format(self.words())])
+            for part in range(1, self._parts + 1):
+                if part > 1:
+                    lines.append(self.image(' class="exarrow" id="ar{}-{}"'.format(
+                        example, part)))
+                lines.extend(['<div class="exanswer" id="ea{}-{}">'.format(example, part),
+                    self.styled(),
+                    '<span class="hint" id="h{}-{}">{}</span>'.format(
+                        example, part, self.words()),
+                    '</div>'])
+            lines.append('</td></tr>')
+        lines.extend(['</tbody></table>', '</div>'])
+        return lines
+
+    def problems(self):
+        lines = ['<div id="p3">']
+        for problem in range(self._problems):
+            correct = self._random.randint(1, 3)
+            lines.extend(['<div class="lessonprob">',
+                '<span class="title">{}</span>'.format(self.words())])
+            for i in range(1, 4):
+                lines.append('<span id="choice{}">{}</span>'.format(i, self.words(3)))
+            for i in range(1, 4):
+                verdict = 'correct. ' if i == correct else 'incorrect.'
+                lines.append('<div class="response" id="rs{}">This answer is {} {}</div>'.format(
+                    i, verdict, self.words()))
+            lines.append('</div>')
+        lines.append('</div>')
+        return lines
+
+
+@contextlib.contextmanager
+def program_folder():
+    '''
+    Runs the scrubber in a temporary copy of the program folder (config and
+    template only), so the real raw and output folders are left alone.
+    '''
+    tmpdir = tempfile.mkdtemp(prefix='scrubber-benchmark-')
+    original = storage.BASE_PATH
+    try:
+        for filename in [htmlscrubber.CONFIG_FILENAME, DEFAULT_TEMPLATE_FILENAME]:
+            shutil.copy(os.path.join(original, filename), tmpdir)
+        os.mkdir(os.path.join(tmpdir, 'raw'))
+        os.mkdir(os.path.join(tmpdir, 'output'))
+
+        storage.BASE_PATH = tmpdir
+        yield tmpdir
+    finally:
+        storage.BASE_PATH = original
+        shutil.rmtree(tmpdir)
+
+def run_benchmark(args):
+    '''
+    Generates the pages, times every stage over all of them, and returns the
+    results as a dictionary.
+    '''
+
+    config = htmlscrubber.load_config()
+    generator = PageGenerator(config, args.seed, args.paragraphs, args.examples,
+        args.parts, args.problems, args.depth)
+    times = {stage: 0.0 for stage in STAGES}
+
+    with program_folder():
+        config = htmlscrubber.load_config()
+        if not args.tokenizer is None:
+            config['DEFAULT']['tokenizer'] = args.tokenizer
+        tokenizer = tokenizer_name(config)
+        pages = []
+        total_bytes = 0
+        for i in range(args.pages):
+            page = 'bench{}'.format(i)
+            filename = storage.resolve_path('raw', page) + '.html'
+            with open(filename, 'w') as page_file:
+                page_file.write(generator.page())
+            total_bytes += os.path.getsize(filename)
+            pages.append((page, filename))
+
+        for repeat in range(args.repeat):
+            for page, filename in pages:
+                start = time.perf_counter()
+                positions = htmlscrubber.index_sections(filename, tokenizer)
+                times['first_pass'] += time.perf_counter() - start
+
+                for target, parser_class, byte_range in zip(htmlscrubber.TARGETS,
+                        htmlscrubber.PARSER_CLASSES, positions):
+                    start = time.perf_counter()
+                    htmlscrubber.parse_section(parser_class, byte_range, filename,
+                        OutputBuffer(), False, config)
+                    times[target] += time.perf_counter() - start
+
+                start = time.perf_counter()
+                htmlscrubber.scrub_file(scrub_args(page), config)
+                times['scrub_file'] += time.perf_counter() - start
+
+        # Memory is traced separately since tracing slows everything down
+        tracemalloc.start()
+        htmlscrubber.scrub_file(scrub_args(pages[0][0]), config)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    processed_pages = args.pages * args.repeat
+    processed_mb = total_bytes * args.repeat / 1e6
+    stages = {}
+    for stage in STAGES:
+        seconds = times[stage]
+        stages[stage] = {
+            'seconds': seconds,
+            'pages_per_sec': processed_pages / seconds if seconds else None,
+            'mb_per_sec': processed_mb / seconds if seconds else None
+        }
+
+    return {
+        'settings': vars(args),
+        'pages': processed_pages,
+        'bytes_per_page': total_bytes / args.pages,
+        'stages': stages,
+        'peak_memory_bytes': peak_memory
+    }
+
+def scrub_args(page):
+    # Always do the full work, never skip through the caches
+    return argparse.Namespace(filename=page, targets=None, interactive=False,
+        defer=False, nocache=True, force=True)
+
+def report(results, baseline=None, threshold=0.1):
+    '''
+    Prints the results, along with the change from the baseline results if
+    given. Returns the stages that got slower than the threshold allows.
+    '''
+
+    print('{} pages of {:.1f} KB'.format(results['pages'],
+        results['bytes_per_page'] / 1e3))
+    print('{:<12} {:>10} {:>10} {:>10} {:>10}'.format(
+        'stage', 'seconds', 'pages/s', 'MB/s', 'change'))
+
+    regressions = []
+    for stage in STAGES:
+        current = results['stages'][stage]
+        change = ''
+        if not baseline is None and stage in baseline['stages']:
+            before = baseline['stages'][stage]['mb_per_sec']
+            if before and current['mb_per_sec']:
+                ratio = current['mb_per_sec'] / before - 1
+                change = '{:+.1%}'.format(ratio)
+                if ratio < -threshold:
+                    regressions.append(stage)
+                    change += ' !'
+
+        print('{:<12} {:>10.3f} {:>10.1f} {:>10.2f} {:>10}'.format(stage,
+            current['seconds'], current['pages_per_sec'] or 0,
+            current['mb_per_sec'] or 0, change))
+
+    print('peak memory: {:.1f} KB'.format(results['peak_memory_bytes'] / 1e3))
+    return regressions
+
+def execute():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the scrubber on synthetic lesson pages')
+
+    parser.add_argument('-pages', type=int, default=20,
+        help='Number of pages to generate.')
+    parser.add_argument('-repeat', type=int, default=3,
+        help='Number of times every page is scrubbed.')
+    parser.add_argument('-paragraphs', type=int, default=20,
+        help='Number of blocks in each topic discussion.')
+    parser.add_argument('-examples', type=int, default=5,
+        help='Number of examples on each page.')
+    parser.add_argument('-parts', type=int, default=3,
+        help='Number of parts in each example solution.')
+    parser.add_argument('-problems', type=int, default=1,
+        help='Number of lesson problems on each page.')
+    parser.add_argument('-depth', type=int, default=3,
+        help='Nesting depth of the plain divisions in the discussion.')
+    parser.add_argument('-tokenizer', type=str, default=None,
+        choices=tokenizer_names(),
+        help='The tokenizer backend to measure (default is the one of '
+        'config.ini).')
+    parser.add_argument('-seed', type=int, default=0,
+        help='Seed for the page generator.')
+    parser.add_argument('-output', type=str, default=None,
+        help='Save the results to this json file.')
+    parser.add_argument('-baseline', type=str, default=None,
+        help='Compare against the results saved in this json file.')
+    parser.add_argument('-threshold', type=float, default=0.1,
+        help='Slowdown (as a fraction) of a stage reported as a regression.')
+
+    args = parser.parse_args()
+
+    baseline = None
+    if not args.baseline is None:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    results = run_benchmark(args)
+    regressions = report(results, baseline, args.threshold)
+
+    if not args.output is None:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=1)
+
+    if regressions:
+        print('Regressions in: {}'.format(', '.join(regressions)))
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.ERROR)
+    exit(execute())
@@ -5,10 +5,7 @@ Contains the classes required to parse the old Math Emporium discussion format
 interactively into the newer, simpler format.
 '''
 
-from functools import partial
 from htmlparse import *
-import logging
-import os
 
 class TopicDiscussionParser(CustomHTMLParser):
     '''
@@ -16,52 +13,25 @@ class TopicDiscussionParser(CustomHTMLParser):
     the option to typeset image files if possible.
     '''
 
-    def __init__(self, file_handler, interactive, config):
-        super(TopicDiscussionParser, self).__init__(file_handler, interactive, config)
-
-    def handle_starttag(self, tag, attrs):
-        logging.debug('{} + {}'.format(self._tag_converters, tag))
-        level = len(self._tag_converters)
-
-        tag_map = {
-            'strong': partial(InlineTagConverter, 'strong', attrs),
-            'b': partial(InlineTagConverter, 'strong', attrs),
-            'i': partial(InlineTagConverter, 'i', attrs),
-            'a': partial(HyperlinkTagConverter, attrs),
-            'table' : partial(TagConverter, include=True),
-            'tbody' : partial(TagConverter, include=True),
-            'tr' : partial(TagConverter, include=True),
-            'td' : partial(TagConverter, include=True)
-        }
-
-        new_converter = None
-
-        if tag == 'div':
-            if ('class', 'contentbox') in attrs:
-                new_converter = NewlineTagConverter('p', level, [])
-            elif ('class', 'beigebox') in attrs:
-                new_converter = NewlineTagConverter('div', level, [('class',
-                'defbox')])
-            elif ('class', 'popuphelpp1') in attrs:
-                new_converter = NewlineTagConverter('div', level, [('class', 'hintbox'), ('id', 'hintContainer?')])
-            else:
-                new_converter = TagConverter(include=True)
-        elif tag == 'img':
-            self.handle_image(attrs)
-        elif tag == 'span':
-            if ('class', 'title') in attrs:
-                new_converter = TitleConverter(attrs)
-            elif ('class', 'flyouthelp') in attrs:
-                new_converter = InlineTagConverter('a', [('id', 'hintLink?')])
-            else:
-                new_converter = DefaultSpanConverter(attrs, self._config)
-        else:
-            if tag in tag_map:
-                new_converter = tag_map[tag]()
-            else:
-                logging.debug('Tag "{}" not supported'.format(tag))
-
-        if not new_converter is None:
-            self._tag_converters.append(new_converter)
-            new_converter.on_tag_start(self._handler)
-
+    def __init__(self, file_handler, interactive, config, defer_images=False):
+        super(TopicDiscussionParser, self).__init__(file_handler, interactive,
+            config, defer_images)
+
+    tag_rules = TagRules([
+        ('div.contentbox', newline('p', [])),
+        ('div.beigebox', newline('div', [('class', 'defbox')])),
+        ('div.popuphelpp1', newline('div', [('class', 'hintbox'), ('id', 'hintContainer?')])),
+        ('div', include),
+        ('img', CustomHTMLParser.convert_image),
+        ('span.title', lambda parser, attrs, level: TitleConverter(attrs)),
+        ('span.flyouthelp', inline('a', [('id', 'hintLink?')])),
+        ('span', CustomHTMLParser.convert_span),
+        ('strong', inline('strong')),
+        ('b', inline('strong')),
+        ('i', inline('i')),
+        ('a', hyperlink),
+        ('table', include),
+        ('tbody', include),
+        ('tr', include),
+        ('td', include)
+    ])
@@ -1,102 +1,91 @@
-from functools import partial
 from html.parser import HTMLParser
 import logging
 import re
 
 from htmlparse import *
+import tracing
 
 
 class ExampleParser(CustomHTMLParser):
-    def __init__(self, outputfile, interactive, config):
-        super(ExampleParser, self).__init__(outputfile, interactive, config)
+    def __init__(self, outputfile, interactive, config, defer_images=False):
+        super(ExampleParser, self).__init__(outputfile, interactive, config,
+            defer_images)
         self._current_example = 0
         self._example_table_tag = None
         self._last_popped = None
 
-    def handle_starttag(self, tag, attrs):
-        new_tag = None
-        level = len(self._tag_converters)
-
-        tag_map = {
-            'strong': partial(InlineTagConverter, 'strong', []),
-            'b': partial(InlineTagConverter, 'strong', []),
-            'i': partial(InlineTagConverter, 'i', []),
-            'a': partial(HyperlinkTagConverter, attrs),
-            'tbody': partial(TagConverter, include=True)
-        }
-
-        if tag == 'span':
-            if ('class', 'questionstatement') in attrs:
-                # Example instructions
-                new_tag = InlineTagConverter('p', [('class', 'examplestatement')]) 
-            elif ('class', 'hint') in attrs:
-                example, hint = self.grab_numbers_from_id(attrs)
-                if hint == 1:
-                    new_tag = NewlineTagConverter('div', level,
-                        [('class', 'hintbox')])
-                else:
-                    new_tag = NewlineTagConverter('div', level,
-                        [('class', 'hintbox'), ('id', 'exampleHint{}-{}'.format(example, hint))])
-            else:
-                new_tag = DefaultSpanConverter(attrs, self._config)
-        elif tag == 'table':
-                # Table to store the examples
-            if ('class', 'example') in attrs:
-                new_tag = NewlineTagConverter('ol', level, [('class', 'questionlist')])
-                self._example_table_tag = new_tag
-            else:
-                new_tag = TagConverter(include=True)
-        elif tag == 'td':
-            if ('class', 'leftcell') in attrs:
-                # Example question text (start new example)
-                self._current_example += 1
-                logging.debug(self._tag_converters)
-                new_tag = NewlineTagConverter('p', level, [])
-            elif ('class', 'exanswerbox') in attrs:
-                # Example solution
-                logging.debug(self._tag_converters)
-                new_tag = ExampleSolution(level, self._current_example)
-            else:
-                new_tag = TagConverter(include=True)
-        elif tag == 'tr':
-            # Questions are divided into rows of a table, assuming the table is
-            # the above ('class', 'example') table. If two parents ago (tbody is
-            # a boring parent) is this table, then we start a new question.
-            if self._example_table_tag is self._tag_converters[-2]:
-                new_tag = NewlineTagConverter('li', level, [])
-            else:
-                new_tag = TagConverter(include=True)
-        elif tag == 'img':
-            if ('class', 'exarrow') in attrs:
-                # This signifies a link to continue in the problem. We need its
-                # id to uncover the correct hint and solution section.
-                # Furthermore, if the last popped element was a
-                # ExamplePartContainer, we need to close it (assuming this isn't
-                # the first part)
-                example, hint = self.grab_numbers_from_id(attrs)
-                link = '<a id="exampleLink{}-{}">Continue</a>'.format(example, hint)
-                if isinstance(self._last_popped, ExamplePartConverter) and not hint == 1:
-                    self._last_popped.close_tag_with_link(self._handler, link)
-                    self._last_popped = None
-                else:
-                    logging.debug('what is this? {} <-------------'.format(attrs))
-            else:
-                self.handle_image(attrs)
-        elif tag == 'div':
-            if ('class', 'exanswer') in attrs:
-                example, part = self.grab_numbers_from_id(attrs)
-                new_tag = ExamplePartConverter(example, part, level)
-            else:
-                new_tag = TagConverter(True)
+    def start_hint(self, attrs, level):
+        example, hint = self.grab_numbers_from_id(attrs)
+        if hint == 1:
+            return NewlineTagConverter('div', level,
+                [('class', 'hintbox')])
         else:
-            if tag in tag_map:
-                new_tag = tag_map[tag]()
-            else:
-                logging.debug('Tag "{}" not supported'.format(tag))
-
-        if not new_tag is None:
-            new_tag.on_tag_start(self._handler)
-            self._tag_converters.append(new_tag)
+            return NewlineTagConverter('div', level,
+                [('class', 'hintbox'), ('id', 'exampleHint{}-{}'.format(example, hint))])
+
+    def start_example_table(self, attrs, level):
+        # Table to store the examples
+        self._example_table_tag = NewlineTagConverter('ol', level, [('class', 'questionlist')])
+        return self._example_table_tag
+
+    def start_example(self, attrs, level):
+        # Example question text (start new example)
+        self._current_example += 1
+        return NewlineTagConverter('p', level, [])
+
+    def start_solution(self, attrs, level):
+        # Example solution
+        return ExampleSolution(level, self._current_example)
+
+    def start_row(self, attrs, level):
+        # Questions are divided into rows of a table, assuming the table is
+        # the above ('class', 'example') table. If two parents ago (tbody is
+        # a boring parent) is this table, then we start a new question.
+        if self._example_table_tag is self._tag_converters[-2]:
+            return NewlineTagConverter('li', level, [])
+        else:
+            return INCLUDED
+
+    def continue_example(self, attrs, level):
+        # This signifies a link to continue in the problem. We need its
+        # id to uncover the correct hint and solution section.
+        # Furthermore, if the last popped element was a
+        # ExamplePartContainer, we need to close it (assuming this isn't
+        # the first part)
+        example, hint = self.grab_numbers_from_id(attrs)
+        link = '<a id="exampleLink{}-{}">Continue</a>'.format(example, hint)
+        if isinstance(self._last_popped, ExamplePartConverter) and not hint == 1:
+            self._last_popped.close_tag_with_link(self._handler, link)
+            self._last_popped = None
+        elif not self._tracer is None:
+            self._tracer.record(tracing.NOTE, self._trace_name,
+                'continue link without an open part', attrs)
+
+    def start_part(self, attrs, level):
+        example, part = self.grab_numbers_from_id(attrs)
+        return ExamplePartConverter(example, part, level)
+
+    tag_rules = TagRules([
+        # Example instructions
+        ('span.questionstatement', inline('p', [('class', 'examplestatement')])),
+        ('span.hint', start_hint),
+        ('span', CustomHTMLParser.convert_span),
+        ('table.example', start_example_table),
+        ('table', include),
+        ('td.leftcell', start_example),
+        ('td.exanswerbox', start_solution),
+        ('td', include),
+        ('tr', start_row),
+        ('img.exarrow', continue_example),
+        ('img', CustomHTMLParser.convert_image),
+        ('div.exanswer', start_part),
+        ('div', include),
+        ('strong', inline('strong', [])),
+        ('b', inline('strong', [])),
+        ('i', inline('i', [])),
+        ('a', hyperlink),
+        ('tbody', include)
+    ])
 
     def handle_endtag(self, tag):
         if not isinstance(self._last_popped, ExamplePartConverter):
@@ -123,6 +112,8 @@ class ExamplePartConverter(NewlineTagConverter):
     must be closed by the containing example solution class (anyway, the "Close
     Example" link is contained int he last ExamplePartContainer
     '''
+
+    __slots__ = []
     def __init__(self, example, part, level):
         id_str = 'exampleContainer{}-{}'.format(example, part)
         if part == 1:
@@ -140,6 +131,8 @@ class ExamplePartConverter(NewlineTagConverter):
 
 
 class ExampleSolution(NewlineTagConverter):
+    __slots__ = ['example']
+
     def __init__(self, level, example):
         id_string = 'exampleContainer{}'.format(example)
         attrs = [('class', 'examplebox'), ('id', id_string)]
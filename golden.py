@@ -0,0 +1,169 @@
+'''
+module golden
+
+A golden set of outputs to verify the scrubber against: every section of every
+page as a known good version of the scrubber converted it, stored as
+<page>/<target>.html files in the golden folder along with an index of their
+sha256 hashes. Comparing a new output only takes hashing it and a lookup, so
+the stored file is only read to show the difference when the hashes disagree.
+
+verify_pages scrubs the pages in memory and either records their sections as
+the golden set or compares them against it, for the -verify and -record flags
+of htmlscrubber.
+'''
+
+import collections
+from concurrent.futures import ProcessPoolExecutor
+import difflib
+import hashlib
+import logging
+import os
+import traceback
+
+import htmlscrubber
+from storage import read_json, resolve_path, write_json
+
+GOLDEN_FOLDER = 'golden'
+GOLDEN_INDEX_FILENAME = 'golden.json'
+
+# The outcome of verifying a page against the golden set, see verify_page
+Verification = collections.namedtuple('Verification',
+    ['page', 'error', 'mismatches', 'outputs'])
+
+
+class GoldenSet():
+    '''
+    The golden outputs kept in a folder. The index maps each page to the hash
+    of each of its targets.
+    '''
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._filename = os.path.join(folder, GOLDEN_INDEX_FILENAME)
+        self._pages = (read_json(self._filename) or {}).get('pages', {})
+
+    def path(self, page, target):
+        return os.path.join(self.folder, page, target) + '.html'
+
+    def hashes(self, page):
+        '''
+        Returns the hash of each golden target of the page.
+        '''
+        return dict(self._pages.get(page, {}))
+
+    def record(self, page, outputs):
+        '''
+        Stores the outputs (target -> text) of the page as golden, replacing
+        the ones recorded for its targets before.
+        '''
+        os.makedirs(os.path.join(self.folder, page), exist_ok=True)
+        hashes = self._pages.setdefault(page, {})
+        for target, text in sorted(outputs.items()):
+            with open(self.path(page, target), 'w', encoding='utf-8',
+                    newline='') as golden_file:
+                golden_file.write(text)
+            hashes[target] = text_hash(text)
+
+    def save(self):
+        os.makedirs(self.folder, exist_ok=True)
+        write_json(self._filename, {'pages': self._pages})
+
+    def __len__(self):
+        return len(self._pages)
+
+    def __repr__(self):
+        return 'GoldenSet({}, {} pages)'.format(self.folder, len(self._pages))
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def compare_outputs(page, outputs, hashes, folder):
+    '''
+    Compares the outputs (target -> text) of the page against the golden
+    hashes. Returns a (target, unified diff lines) tuple for each target that
+    differs; the diff is None if the target has no golden output.
+    '''
+
+    mismatches = []
+    for target, text in sorted(outputs.items()):
+        expected = hashes.get(target)
+        if expected == text_hash(text):
+            continue
+
+        diff = None
+        if not expected is None:
+            golden_filename = os.path.join(folder, page, target) + '.html'
+            with open(golden_filename, encoding='utf-8', newline='') as golden_file:
+                golden_text = golden_file.read()
+            diff = list(difflib.unified_diff(golden_text.splitlines(True),
+                text.splitlines(True), 'golden/{}/{}'.format(page, target),
+                'scrubbed/{}/{}'.format(page, target)))
+        mismatches.append((target, diff))
+
+    return mismatches
+
+def verify_pages(pages, args, config):
+    '''
+    Scrubs the pages in memory across a process pool, then either records
+    their sections as the golden set or compares them against it, logging a
+    diff of every section that differs. Returns the pages that differ (or
+    failed).
+    '''
+
+    golden = GoldenSet(resolve_path(args.golden))
+    logging.info('{} {} pages against {}'.format(
+        'Recording' if args.record else 'Verifying', len(pages), golden))
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(verify_page, page, config, args.targets,
+            golden.folder, None if args.record else golden.hashes(page))
+            for page in pages]
+        verifications = [future.result() for future in futures]
+
+    failed = []
+    for verification in verifications:
+        if not verification.error is None:
+            logging.error('Scrubbing "{}" failed:\n{}'.format(verification.page,
+                verification.error))
+            failed.append(verification.page)
+        elif args.record:
+            golden.record(verification.page, verification.outputs)
+        elif verification.mismatches:
+            for target, diff in verification.mismatches:
+                if diff is None:
+                    logging.error('No golden {} for "{}"'.format(target,
+                        verification.page))
+                else:
+                    logging.error('The {} of "{}" differs:\n{}'.format(target,
+                        verification.page, ''.join(diff)))
+            failed.append(verification.page)
+
+    if args.record:
+        golden.save()
+        logging.info('Recorded {} pages, {} failed'.format(
+            len(pages) - len(failed), len(failed)))
+    else:
+        logging.info('Verified {} pages: {} identical, {} differ'.format(
+            len(pages), len(pages) - len(failed), len(failed)))
+    return failed
+
+def verify_page(page, config, targets, golden_folder, hashes=None):
+    '''
+    Scrubs the page in memory and compares its sections against the golden
+    hashes, returning a Verification of the page, the formatted traceback of
+    the error (or None), and the (target, diff) of every section that
+    differs. Without hashes, the sections are returned in the outputs instead,
+    to be recorded.
+    '''
+
+    try:
+        with open(resolve_path('raw', page) + '.html', 'rb') as infile:
+            outputs = htmlscrubber.scrub_text(infile.read(), config, targets)
+    except Exception:
+        return Verification(page, traceback.format_exc(), None, None)
+
+    if hashes is None:
+        return Verification(page, None, None, outputs)
+    return Verification(page, None,
+        compare_outputs(page, outputs, hashes, golden_folder), None)
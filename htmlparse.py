@@ -1,18 +1,115 @@
 from html.parser import HTMLParser
 import logging
-import os
-import tempfile
+import threading
+import time
+
+import stats
+import tracing
+from transcriptions import TranscriptionStore, image_key, image_path, \
+    placeholder, prompt_image_text
+
+class TagRules():
+    '''
+    Declares which converter each tag becomes. The rules are (selector,
+    factory) pairs, where the selector is a tag name optionally followed by
+    ".class" or "#id", and the factory is called with the parser, the tag
+    attributes, and the nesting level to create the converter (or None if the
+    tag is handled without one). The rules are compiled once into dictionaries,
+    so matching a tag only costs a lookup per class or id attribute: a class
+    rule beats an id rule, which beats a rule for the bare tag.
+    '''
+
+    def __init__(self, rules):
+        self._by_class = {}
+        self._by_id = {}
+        self._by_tag = {}
+
+        for selector, factory in rules:
+            if '.' in selector:
+                tag, class_name = selector.split('.', 1)
+                self._by_class[(tag, class_name)] = factory
+            elif '#' in selector:
+                tag, id_name = selector.split('#', 1)
+                self._by_id[(tag, id_name)] = factory
+            else:
+                self._by_tag[selector] = factory
+
+        # Tags with a class or id rule need their attributes looked at
+        self._selective_tags = {tag for tag, value in self._by_class} | \
+            {tag for tag, value in self._by_id}
+
+    def match(self, tag, attrs):
+        '''
+        Returns the factory of the rule matching the tag, or None.
+        '''
+        if tag in self._selective_tags:
+            id_factory = None
+            for attr, value in attrs:
+                if attr == 'class':
+                    factory = self._by_class.get((tag, value))
+                    if not factory is None:
+                        return factory
+                elif attr == 'id' and id_factory is None:
+                    id_factory = self._by_id.get((tag, value))
+
+            if not id_factory is None:
+                return id_factory
+
+        return self._by_tag.get(tag)
+
+    def __repr__(self):
+        return 'TagRules({} rules)'.format(
+            len(self._by_class) + len(self._by_id) + len(self._by_tag))
+
+
+def include(parser, attrs, level):
+    '''
+    Rule factory for a tag whose contents are kept without the tag itself.
+    '''
+    return INCLUDED
+
+def inline(tag_name, new_attrs=None):
+    '''
+    Rule factory for an InlineTagConverter. The original attributes are kept
+    unless new ones are given.
+    '''
+    if new_attrs is None:
+        return lambda parser, attrs, level: InlineTagConverter(tag_name, attrs)
+    return lambda parser, attrs, level: InlineTagConverter(tag_name, new_attrs)
+
+def newline(tag_name, new_attrs):
+    '''
+    Rule factory for a NewlineTagConverter indented to the nesting level.
+    '''
+    return lambda parser, attrs, level: NewlineTagConverter(tag_name, level, new_attrs)
+
+def hyperlink(parser, attrs, level):
+    return HyperlinkTagConverter(attrs)
+
 
 class CustomHTMLParser(HTMLParser):
     '''
     Rip the contents of the file into a plainer format and present the user with
-    the option to typeset image files if possible.
+    the option to typeset image files if possible. When deferring images,
+    images without a stored transcription are replaced by a placeholder and
+    listed in deferred_images, to be typeset later in a transcription session.
+
+    Subclasses declare how each tag is converted through their tag_rules.
     '''
 
-    def __init__(self, file_handler, interactive, config):
+    # Bump whenever a change to the parser changes its output, so that the
+    # outputs built by the older version are rebuilt. Version 2 is fed exactly
+    # the markup from the opening division of its section through the closing
+    # one, whether the section positions were cached or not
+    version = 2
+
+    tag_rules = TagRules([])
+
+    def __init__(self, file_handler, interactive, config, defer_images=False):
         super(CustomHTMLParser, self).__init__()
         self._handler = file_handler
         self._interactive = interactive
+        self._defer_images = defer_images
         self._config = config
 
         # Keep a list of tag converters. Every time a new tag is encountered, we
@@ -20,15 +117,117 @@ class CustomHTMLParser(HTMLParser):
         # the data, and we pop it when the end tag is encountered.
         self._tag_converters = []
 
+        # The kinds of inputs the output depended on besides the raw file
+        # (colors, images, template), recorded in the build manifest
+        self.dependencies = set()
+        self.images = []
+        self.deferred_images = []
+        self._transcriptions = TranscriptionStore.from_config(config)
+        self._colors = ColorTable.from_config(config)
+
+        self._tracer = tracing.tracer
+        self._trace_name = type(self).__name__
+
+        self._stats = stats.current()
+        if not self._stats is None:
+            self.instrument(self._stats)
+
+    def instrument(self, collected):
+        '''
+        Replaces the handlers of this parser with versions that time them and
+        count what they see. Done per instance, so the parsers created while no
+        stats are collected run untouched.
+        '''
+        perf_counter = time.perf_counter
+        times, counts = collected.times, collected.counts
+        converters = self._tag_converters
+        handle_starttag = self.handle_starttag
+        handle_endtag = self.handle_endtag
+        handle_data = self.handle_data
+        get_image_text = self.get_image_text
+
+        def timed_starttag(tag, attrs):
+            depth = len(converters)
+            start = perf_counter()
+            handle_starttag(tag, attrs)
+            times['dispatch'] += perf_counter() - start
+            counts['tags'] += 1
+            if len(converters) > depth:
+                counts['converter ' + type(converters[-1]).__name__] += 1
+
+        def timed_endtag(tag):
+            start = perf_counter()
+            handle_endtag(tag)
+            times['dispatch'] += perf_counter() - start
+
+        def timed_data(data):
+            start = perf_counter()
+            handle_data(data)
+            times['dispatch'] += perf_counter() - start
+            counts['data chars'] += len(data)
+
+        def timed_image_text(image_attrs):
+            start = perf_counter()
+            content = get_image_text(image_attrs)
+            times['images'] += perf_counter() - start
+            counts['images'] += 1
+            return content
+
+        self.handle_starttag = timed_starttag
+        self.handle_endtag = timed_endtag
+        self.handle_data = timed_data
+        self.get_image_text = timed_image_text
+
+    def handle_starttag(self, tag, attrs):
+        factory = self.tag_rules.match(tag, attrs)
+        if factory is None:
+            if not self._tracer is None:
+                self._tracer.record(tracing.SKIPPED_TAG, self._trace_name, tag)
+            return
+
+        new_converter = factory(self, attrs, len(self._tag_converters))
+        if not self._tracer is None:
+            self._tracer.record(tracing.START_TAG, self._trace_name, tag,
+                len(self._tag_converters), type(new_converter).__name__)
+        if not new_converter is None:
+            new_converter.on_tag_start(self._handler)
+            self._tag_converters.append(new_converter)
+
     def handle_endtag(self, tag):
+        if not self._tracer is None:
+            self._tracer.record(tracing.END_TAG, self._trace_name, tag,
+                len(self._tag_converters))
         self._tag_converters[-1].on_tag_end(self._handler)
         self._tag_converters.pop(-1)
 
     def handle_data(self, data):
         data = data.replace('\n', '').replace('\r', '').replace('\t', '')
         if all(self._tag_converters) and data:
+            if not self._tracer is None:
+                self._tracer.record(tracing.DATA, self._trace_name,
+                    tracing.preview(data))
             self._tag_converters[-1].on_tag_data(self._handler, data)
 
+    def end_section(self):
+        '''
+        Called once the section is over, after its closing tag (or the end of
+        the input, if it is never closed) was handled.
+        '''
+        pass
+
+    def convert_span(self, attrs, level):
+        self.dependencies.add('colors')
+        if self._stats is None:
+            return DefaultSpanConverter(attrs, self._colors)
+
+        with self._stats.stage('colors'):
+            converter = DefaultSpanConverter(attrs, self._colors)
+        self._stats.count('color lookups')
+        return converter
+
+    def convert_image(self, attrs, level):
+        self.handle_image(attrs)
+
     def handle_image(self, image_attrs):
         content = self.get_image_text(image_attrs)
         self._handler.write(' {} '.format(content))
@@ -37,46 +236,61 @@ class CustomHTMLParser(HTMLParser):
         for attr, value in image_attrs:
             if attr == 'src':
                 logging.info('Handling image {}'.format(value))
-                content = ''
-                if self._interactive:
-                    # Show the image using config command
-                    imgpath = os.path.join('raw', value)
-                    img_show_command = self._config['DEFAULT']['image_command']
-                    img_show_command = img_show_command.format(imgpath)
-                    os.system(img_show_command)
-
-                    # Ask the user for the text. Do this by create a file that
-                    # the user can modify with the specified text editor in the
-                    # config.
-                    with tempfile.TemporaryDirectory() as tmpdir:
-                        # Name of the file will be the image basename
-                        filename = os.path.basename(imgpath)
-                        filename = os.path.splitext(filename)[0]
-                        filename += '.tex'
-                        filename = os.path.join(tmpdir, filename)
-                        open(filename, 'a').close() # Just make the file
-
-                        text_edit_command = self._config['DEFAULT']['text_edit_command']
-                        text_edit_command = text_edit_command.format(filename)
-                        os.system(text_edit_command)
-
-                        with open(filename) as tmpfile:
-                            content = tmpfile.read().rstrip()
-                            if content == self._config['DEFAULT']['abort_text']:
-                                raise Exception('Abort text encountered while handling image')
-                        # Closes file
-                    # Removes temporary directory
+                self.dependencies.add('images')
+                self.images.append(value)
+
+                # Images typeset before (on any page) are never asked again
+                content = self._transcriptions.lookup(value)
+                if content is None:
+                    content = ''
+                    if self._defer_images:
+                        key = image_key(value)
+                        self.deferred_images.append((key, value))
+                        return placeholder(key)
+                    elif self._interactive:
+                        content = prompt_image_text(image_path(value), self._config)
+                        if content:
+                            self._transcriptions.store(value, content)
+                else:
+                    logging.info('Using stored transcription for {}'.format(value))
+                    if not self._stats is None:
+                        self._stats.count('stored transcriptions')
 
                 if not content:
                     content = self._config['DEFAULT']['default_image_text']
                 
                 return content
-                
+
+class OutputBuffer():
+    '''
+    Collects the many small fragments the converters write in a list, so the
+    section can be written out (or returned as a string) all at once instead
+    of fragment by fragment.
+    '''
+
+    def __init__(self):
+        self._fragments = []
+        # Skip a method call per fragment
+        self.write = self._fragments.append
+
+    def getvalue(self):
+        return ''.join(self._fragments)
+
+    def clear(self):
+        # In place, so the bound write stays valid
+        del self._fragments[:]
+
+    def __repr__(self):
+        return 'OutputBuffer({} fragments)'.format(len(self._fragments))
+
 
 class TagConverter():
     '''
     Generic class for converting tags from the old format to the new.
     '''
+
+    __slots__ = ['_include']
+
     def __init__(self, include=False):
         self._include = include
 
@@ -101,21 +315,45 @@ class TagConverter():
         return self._include
 
 
+# A plain TagConverter holds no state besides the flag, so every included tag
+# shares this one
+INCLUDED = TagConverter(include=True)
+
+# Number of distinct tag strings kept before the cache starts over
+TAG_STRING_CACHE_SIZE = 4096
+
+
 class WrappedTagConverter(TagConverter):
     '''
     Used when the old tag data just needs to be put (inline) as a new tag.
+    The start and end tags are built by format_tags once per class, tag,
+    attributes, and level, and reused by every converter alike.
     '''
 
-    def __init__(self, tag_name, attrs):
+    __slots__ = ['tag', 'start_tag', 'end_tag']
+
+    # (class, tag name, attributes, level) -> (start tag, end tag)
+    _tag_strings = {}
+
+    def __init__(self, tag_name, attrs, level=0):
         super(WrappedTagConverter, self).__init__(include=True)
         self.tag = tag_name 
+
+        key = (type(self), tag_name, tuple(attrs), level)
+        tags = self._tag_strings.get(key)
+        if tags is None:
+            if len(self._tag_strings) >= TAG_STRING_CACHE_SIZE:
+                self._tag_strings.clear()
+            tags = self._tag_strings[key] = self.format_tags(tag_name, attrs, level)
+        self.start_tag, self.end_tag = tags
+
+    def format_tags(self, tag_name, attrs, level):
         attr_str = ', '.join(['{}="{}"'.format(*attr) for attr in attrs])
 
         if attr_str:
             attr_str = ' ' + attr_str
 
-        self.start_tag = '<{}{}>'.format(tag_name, attr_str)
-        self.end_tag = '</{}>'.format(tag_name)
+        return '<{}{}>'.format(tag_name, attr_str), '</{}>'.format(tag_name)
 
     def on_tag_start(self, writer):
         writer.write(self.start_tag)
@@ -134,11 +372,13 @@ class InlineTagConverter(WrappedTagConverter):
     '''
     Same as parent, but add spaces around the tag
     '''
-    
-    def __init__(self, tag_name, attrs):
-        super(InlineTagConverter, self).__init__(tag_name, attrs)
-        self.start_tag = ' ' + self.start_tag
-        self.end_tag = self.end_tag + ' '
+
+    __slots__ = []
+
+    def format_tags(self, tag_name, attrs, level):
+        start_tag, end_tag = super(InlineTagConverter, self).format_tags(
+            tag_name, attrs, level)
+        return ' ' + start_tag, end_tag + ' '
 
 
 class NewlineTagConverter(WrappedTagConverter):
@@ -147,11 +387,17 @@ class NewlineTagConverter(WrappedTagConverter):
     spacing.
     '''
 
+    __slots__ = ['_level']
+
     def __init__(self, tag_name, level, attrs):
-        super(NewlineTagConverter, self).__init__(tag_name, attrs)
         self._level = level
-        self.start_tag = '\n{0}{1}\n{0}'.format(self.tabs(), self.start_tag)
-        self.end_tag = '\n{0}{1}'.format(self.tabs(), self.end_tag)
+        super(NewlineTagConverter, self).__init__(tag_name, attrs, level)
+
+    def format_tags(self, tag_name, attrs, level):
+        start_tag, end_tag = super(NewlineTagConverter, self).format_tags(
+            tag_name, attrs, level)
+        tabs = self.tabs()
+        return '\n{0}{1}\n{0}'.format(tabs, start_tag), '\n{0}{1}'.format(tabs, end_tag)
 
     def tabs(self):
         return '\t'*self._level
@@ -161,44 +407,130 @@ class NewlineTagConverter(WrappedTagConverter):
 
 
 class TitleConverter(WrappedTagConverter):
+    __slots__ = []
+
     def __init__(self, attrs):
         super(TitleConverter, self).__init__('p', [])
-        self.start_tag = self.start_tag + '<strong>'
-        self.end_tag = '</strong>' + self.end_tag + '\n'
+
+    def format_tags(self, tag_name, attrs, level):
+        start_tag, end_tag = super(TitleConverter, self).format_tags(
+            tag_name, attrs, level)
+        return start_tag + '<strong>', '</strong>' + end_tag + '\n'
 
 
 class HyperlinkTagConverter(InlineTagConverter):
+    __slots__ = []
+
     def __init__(self, attrs):
         new_attrs = [('target', '_blank'), ('href', '!!URL!!')]
         super(HyperlinkTagConverter, self).__init__('a', new_attrs)
 
 
 class DefaultSpanConverter(InlineTagConverter):
-    def __init__(self, attrs, config):
-        new_color_attrs = self.get_color(attrs, config)
+    __slots__ = []
+
+    def __init__(self, attrs, colors):
+        new_color_attrs = self.get_color(attrs, colors)
         super(DefaultSpanConverter, self).__init__('span', new_color_attrs)
 
-    def get_color(self, attrs, config):
+    def get_color(self, attrs, colors):
         for attr in attrs:
             if attr[0] == 'style':
                 old_color_hex = attr[1][7:]
                 if old_color_hex == '': # Somehow this was possible in the old format
                     return []
-                try:
-                    old_color_name = config['OLD_COLOR_NAMES'][old_color_hex]
-                except KeyError:
-                    raise KeyError('Hex value {} not specified in config'.format(old_color_hex))
-
-                try:
-                    new_color_name = config['COLOR_MAPPING'][old_color_name]
-                except KeyError:
-                    raise KeyError('Conversion of color {} not handled in config file'.format(old_color_name))
-
-                try:
-                    new_color_hex = config['NEW_COLOR_HEX_VALUES'][new_color_name]
-                except KeyError:
-                    raise KeyError('Hex value for color {} not provided in config file'.format(new_color_name))
-
-                return [('style', 'color:#{};'.format(new_color_hex))]
+                return colors.lookup(old_color_hex)
         else:
             return []
+
+
+class ColorTable():
+    '''
+    The color sections of the config, compiled into a flat table from each old
+    hex value straight to the new style attributes. Old hex values whose chain
+    through OLD_COLOR_NAMES, COLOR_MAPPING, and NEW_COLOR_HEX_VALUES is broken
+    map to the error raised when they are looked up, so that every gap can be
+    reported before any file is touched.
+    '''
+
+    # Tables already compiled in this process, by the contents of the sections
+    _compiled = {}
+    _compiled_lock = threading.Lock()
+
+    def __init__(self, config):
+        self._attrs = {}
+        self._errors = {}
+        self.unused = []
+
+        mapped_names = set()
+        for old_color_hex, old_color_name in own_items(config, 'OLD_COLOR_NAMES'):
+            try:
+                new_color_name = config['COLOR_MAPPING'][old_color_name]
+            except KeyError:
+                self._errors[old_color_hex] = 'Conversion of color {} not handled in config file'.format(old_color_name)
+                continue
+            mapped_names.add(old_color_name)
+
+            try:
+                new_color_hex = config['NEW_COLOR_HEX_VALUES'][new_color_name]
+            except KeyError:
+                self._errors[old_color_hex] = 'Hex value for color {} not provided in config file'.format(new_color_name)
+                continue
+
+            self._attrs[old_color_hex] = [('style', 'color:#{};'.format(new_color_hex))]
+
+        self.unused = [name for name, value in own_items(config, 'COLOR_MAPPING')
+            if not name in mapped_names]
+
+    @classmethod
+    def from_config(cls, config):
+        '''
+        Returns the compiled table for the config, compiling it only the first
+        time these color sections are seen in the process.
+        '''
+        # Keyed by the raw values (and the defaults they may refer to), which
+        # is much cheaper than interpolating every option on every parser
+        key = (tuple(sorted(config.defaults().items())),) + tuple(
+            tuple(config.items(section, raw=True)) if config.has_section(section)
+            else () for section in
+            ['OLD_COLOR_NAMES', 'COLOR_MAPPING', 'NEW_COLOR_HEX_VALUES'])
+        with cls._compiled_lock:
+            table = cls._compiled.get(key)
+            if table is None:
+                table = cls._compiled[key] = cls(config)
+        return table
+
+    def lookup(self, old_color_hex):
+        # Config options are case insensitive
+        key = old_color_hex.lower()
+        try:
+            return self._attrs[key]
+        except KeyError:
+            pass
+
+        if key in self._errors:
+            raise KeyError(self._errors[key])
+        raise KeyError('Hex value {} not specified in config'.format(old_color_hex))
+
+    def problems(self):
+        '''
+        Returns a message for every old hex value that cannot be converted.
+        '''
+        return ['{}: {}'.format(old_color_hex, error)
+            for old_color_hex, error in sorted(self._errors.items())]
+
+    def __repr__(self):
+        return 'ColorTable({} colors, {} errors)'.format(len(self._attrs), len(self._errors))
+
+
+def own_items(config, section):
+    '''
+    Returns the (interpolated) options of a config section, leaving out the
+    inherited DEFAULT options.
+    '''
+    if not config.has_section(section):
+        return []
+
+    defaults = config.defaults()
+    return [(key, config[section][key]) for key in config[section]
+        if not key in defaults]
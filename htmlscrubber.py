@@ -1,30 +1,160 @@
 #!/usr/bin/python3
 
 import argparse
+import bisect
+import codecs
+import collections
+from concurrent.futures import ProcessPoolExecutor
 import configparser
+import difflib
+import glob
 from html.parser import HTMLParser
+import io
+import locale
 import logging
+import mmap
 import os
+import signal
+import sys
+import time
+import traceback
 
 from discussion import TopicDiscussionParser
+import golden
 from example import ExampleParser
-from problem import ProblemParser
+from htmlparse import ColorTable, OutputBuffer
+from manifest import MANIFEST_FILENAME, BuildManifest
+from problem import DEFAULT_TEMPLATE_FILENAME, ProblemParser, ProblemTemplate
+from sectioncache import config_digest, section_digest, section_key, \
+    shared_cache
+from sinks import MemorySink, open_sink
+import stats
+import tracing
+from storage import hash_file, resolve_path
+from tokenizers import DEFAULT_TOKENIZER, TOKENIZERS, AlteredTokenizer, \
+    event_source, tokenizer_name, tokenizer_names
+from transcriptions import DEFAULT_TRANSCRIPTION_FILENAME, queue_images, \
+    transcribe_queue
+from watch import DEFAULT_INTERVAL, Watcher
+
+# The encoding a raw file would be read with in text mode
+ENCODING = locale.getpreferredencoding(False)
+
+# Bump whenever the way section positions are computed changes, so that stale
+# cached positions are ignored
+POSITION_CACHE_VERSION = 3
+POSITION_CACHE_FILENAME = '.positions.json'
+
+CONFIG_FILENAME = 'config.ini'
+
+# The sections of a page and the parser of each
+TARGETS = ['discussion', 'examples', 'problem']
+PARSER_CLASSES = [TopicDiscussionParser, ExampleParser, ProblemParser]
+
+# Images deferred while scrubbing any page, shared across the output directory
+IMAGE_QUEUE_FILENAME = '.image_queue'
+
+# Streaming reads the input in chunks of this many bytes (or characters)
+CHUNK_SIZE = 1 << 16
+SECTION_MARKER = '\n<!-- {} -->\n'
+
+# The page the comparison of the tokenizers is checked on, with some text in
+# each section, see check_compare_tokenizers
+TOKENIZER_CHECK_PAGE = '''<div id="p1"><div class="contentbox">Some text</div></div>
+<div id="p2"><span class="questionstatement">Some text</span></div>
+<div id="p3"><div class="lessonprob"><span class="title">Some text</span>
+<span id="choice1">1</span><span id="choice2">2</span><span id="choice3">3</span>
+</div></div>
+'''
+
+# The outcome of scrubbing a page in a batch, see scrub_page
+PageResult = collections.namedtuple('PageResult',
+    ['page', 'seconds', 'cached', 'error', 'stats', 'outputs', 'state'])
 
 
 class FirstPassParser(HTMLParser):
     '''
     Does a quick pass of the file and determines the sections of the file which
     define the discussion, examples, and problems. The division of the sections
-    are contained in the positions property
+    are contained in the positions property as [start, end) byte offsets from
+    the opening division tag through the end of the closing one, so a range
+    holds exactly the markup the single pass routes to the section. Feed the
+    raw file one line at a time with feed_line so the offsets can be tracked.
+    The tags come from the named tokenizer backend (see tokenizers).
     '''
 
-    def __init__(self):
+    def __init__(self, tokenizer=DEFAULT_TOKENIZER):
         super(FirstPassParser, self).__init__()
+        self._source = event_source(self, tokenizer)
         self._level = 0
         self._page = self._currentlevel = -1
         self.positions = [[-1,-1], [-1,-1], [-1,-1]]
+
+        # The raw lines fed, and the byte offset at which each starts, plus
+        # the end of the last
+        self._lines = []
+        self._line_offsets = [0]
         logging.debug('Created First Pass Parser')
 
+    def feed_line(self, line):
+        for part in split_lines(line):
+            self._lines.append(part)
+            self._line_offsets.append(self._line_offsets[-1] + len(part))
+            self._source.feed(decode_line(part))
+
+    def line_offset(self, line_number):
+        '''
+        Returns the byte offset at which the line (counting from 0) starts.
+        '''
+        return self._line_offsets[line_number]
+
+    def source_offset(self, position):
+        '''
+        Returns the byte offset of a (line, column) position of the tokenizer,
+        whose column counts decoded characters.
+        '''
+        line, column = position
+        raw = self._lines[line - 1]
+        if not isinstance(raw, str):
+            column = len(decode_line(raw)[:column].encode(ENCODING))
+        return self.line_offset(line - 1) + column
+
+    def tag_end_offset(self, position):
+        '''
+        Returns the byte offset just past the tag starting at the position.
+        '''
+        line = position[0] - 1
+        start = self.source_offset(position) - self.line_offset(line)
+        while True:
+            raw = self._lines[line]
+            found = raw.find('>' if isinstance(raw, str) else b'>', start)
+            if found != -1:
+                return self.line_offset(line) + found + 1
+            line += 1
+            start = 0
+
+    def raw_range(self, start, end):
+        '''
+        Returns what was fed in the [start, end) byte range.
+        '''
+        first = bisect.bisect_right(self._line_offsets, start) - 1
+        last = bisect.bisect_left(self._line_offsets, end)
+        lines = self._lines[first:last]
+        offset = self.line_offset(first)
+        return lines[0][:0].join(lines)[start - offset:end - offset]
+
+    def start_section(self, i):
+        '''
+        Called when section i starts, before any of its tags are handled.
+        '''
+        pass
+
+    def current_section(self):
+        '''
+        Returns the index of the section being read, or -1 between sections.
+        '''
+        return self._page
+
     def handle_starttag(self, tag, attrs):
         if tag == 'div':
             for i in range(3):
@@ -32,11 +162,14 @@ class FirstPassParser(HTMLParser):
                 if ('id', idstr) in attrs:
                     logging.debug('Page {} started at {}'.format(
                         i+1,
-                        self.getpos()))
-                    self.positions[i][0] = self.getpos()[0] - 1
+                        self._source.getpos()))
+                    # The end of an earlier occurrence no longer applies
+                    self.positions[i] = [self.source_offset(
+                        self._source.getpos()), -1]
                     self._page = i
 
                     self._currentlevel = self._level
+                    self.start_section(i)
 
             self._level += 1
 
@@ -48,103 +181,1206 @@ class FirstPassParser(HTMLParser):
                 i = self._page
                 logging.debug('Ended Page {} at {}'.format(
                     i+1,
-                    self.getpos()))
+                    self._source.getpos()))
                 
-                self.positions[i][1] = self.getpos()[0] - 1
+                self.positions[i][1] = self.tag_end_offset(
+                    self._source.getpos())
                 self._currentlevel = self._page = -1
 
-def execute():
+
+class SinglePassParser(FirstPassParser):
+    '''
+    Tracks the sections of the file exactly as the first pass does, and routes
+    the tag and data events of each section to the matching section parser.
+    Thus, the file only needs to be read once. Since the first pass keeps the
+    position of the last occurrence of a section only, the events of each
+    section are recorded, and those of its last occurrence are handed to its
+    parser once every line was fed. A section without a parser (None) is
+    skipped.
+    '''
+
+    def __init__(self, section_parsers, tokenizer=DEFAULT_TOKENIZER):
+        super(SinglePassParser, self).__init__(tokenizer)
+        self._parsers = section_parsers
+
+        # What the events of each section are routed to
+        self._section_parsers = [None, None, None]
+
+    def start_section(self, i):
+        if self._parsers[i] is None:
+            return
+        if not self._section_parsers[i] is None:
+            logging.warning('Section {} appears again, so only its last '
+                'occurrence is converted'.format(TARGETS[i]))
+        self._section_parsers[i] = EventRecorder(self._parsers[i])
+
+    def current_section_parser(self):
+        if self._page == -1:
+            return None
+        return self._section_parsers[self._page]
+
+    def handle_starttag(self, tag, attrs):
+        # The section division itself belongs to the section, so the page must
+        # be updated before routing
+        super(SinglePassParser, self).handle_starttag(tag, attrs)
+        section_parser = self.current_section_parser()
+        if not section_parser is None:
+            section_parser.handle_starttag(tag, attrs)
+
+    def handle_endtag(self, tag):
+        # Likewise, the closing division belongs to the section, so grab the
+        # parser before the page is reset
+        section_parser = self.current_section_parser()
+        super(SinglePassParser, self).handle_endtag(tag)
+        if not section_parser is None:
+            section_parser.handle_endtag(tag)
+            if self._page == -1:
+                section_parser.end_section()
+
+    def handle_data(self, data):
+        section_parser = self.current_section_parser()
+        if not section_parser is None:
+            section_parser.handle_data(data)
+
+    def finish(self):
+        '''
+        Called once every line was fed. Ends the section left open, if any,
+        and converts each section.
+        '''
+        section_parser = self.current_section_parser()
+        if not section_parser is None:
+            section_parser.end_section()
+        for i, recorder in enumerate(self._section_parsers):
+            if not recorder is None:
+                self.convert_section(i, recorder)
+
+    def convert_section(self, i, recorder):
+        '''
+        Converts section i by handing its recorded events to its parser.
+        '''
+        recorder.replay()
+
+
+class CachingSinglePassParser(SinglePassParser):
+    '''
+    Routes the sections like the single pass, but before the recorded events
+    of a section are replayed, its raw bytes are looked up in the section
+    cache (see sectioncache): on a hit the stored output is written instead,
+    otherwise the events are replayed into the section parser and its output
+    is stored. Thus, a section seen before is only tokenized, never converted
+    again. The writers must be fresh OutputBuffers.
+    '''
+
+    def __init__(self, section_parsers, writers, cache, config, image_mode,
+            tokenizer=DEFAULT_TOKENIZER):
+        super(CachingSinglePassParser, self).__init__(section_parsers,
+            tokenizer)
+        self._writers = writers
+        self._cache = cache
+        self._config = config
+        self._config_hash = config_digest(config)
+        self._image_mode = image_mode
+        self._tokenizer = tokenizer
+
+    def convert_section(self, i, recorder):
+        start, end = self.positions[i]
+        if end == -1:
+            # A section never closed is converted as it is
+            recorder.replay()
+            return
+
+        data = self.raw_range(start, end)
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        convert_cached(self._cache, self._parsers[i], self._writers[i], data,
+            recorder.replay, self._config, self._config_hash, self._image_mode,
+            self._tokenizer)
+
+
+class EventRecorder():
+    '''
+    Stands in for a section parser, keeping the events meant for it so they
+    can be handed to it later.
+    '''
+
+    __slots__ = ['events', '_parser']
+
+    def __init__(self, parser):
+        self._parser = parser
+        self.events = []
+
+    def handle_starttag(self, tag, attrs):
+        self.events.append((self._parser.handle_starttag, (tag, attrs)))
+
+    def handle_endtag(self, tag):
+        self.events.append((self._parser.handle_endtag, (tag,)))
+
+    def handle_data(self, data):
+        self.events.append((self._parser.handle_data, (data,)))
+
+    def end_section(self):
+        self.events.append((self._parser.end_section, ()))
+
+    def replay(self):
+        for handler, args in self.events:
+            handler(*args)
+        self.events = []
+
+    def __repr__(self):
+        return 'EventRecorder({}, {} events)'.format(
+            type(self._parser).__name__, len(self.events))
+
+
+class StreamingParser(SinglePassParser):
+    '''
+    Routes the sections like the single pass, but a new section parser is
+    created every time a section starts, and its events go straight to it
+    rather than being recorded, writing to the output as they come. Thus,
+    any number of pages can be streamed through one after the other, and only
+    the state of the current section (mostly its open tags) is kept in memory.
+    No positions are tracked. Each section is preceded by a comment naming it.
+    '''
+
+    def __init__(self, writer, targets, interactive, config):
+        super(StreamingParser, self).__init__([None, None, None],
+            tokenizer_name(config))
+        self._writer = writer
+        self._targets = targets
+        self._interactive = interactive
+        self._config = config
+
+    def feed_line(self, line):
+        for part in split_lines(line):
+            self._source.feed(decode_line(part))
+
+    def source_offset(self, position):
+        return -1
+
+    def tag_end_offset(self, position):
+        return -1
+
+    def start_section(self, i):
+        target, parser_class = TARGETS[i], PARSER_CLASSES[i]
+        if target in self._targets:
+            self._writer.write(SECTION_MARKER.format(target))
+            self._section_parsers[i] = parser_class(self._writer,
+                self._interactive, self._config)
+        else:
+            self._section_parsers[i] = None
+
+    def convert_section(self, i, section_parser):
+        # Already written as it was read
+        pass
+
+
+class Scrubber():
+    '''
+    A scrubber to embed in other programs. The config, color table, and problem
+    template are loaded once when it is created, and pages are then scrubbed
+    entirely in memory, so it is cheap to call repeatedly from a long-lived
+    process. Every call creates its own parsers, so a scrubber can be shared
+    between threads as long as its config is not modified.
+    '''
+
+    def __init__(self, config_filename=CONFIG_FILENAME, defer_images=False):
+        self.config_filename = config_filename
+        self.config = load_config(config_filename)
+        self._defer_images = defer_images
+
+        # Warm up everything the parsers share
+        self.colors = ColorTable.from_config(self.config)
+        self.template = ProblemTemplate.from_config(self.config)
+
+    def scrub(self, html, targets=None):
+        '''
+        Scrubs a page given as a string or bytes. Returns a dictionary from each
+        requested target (all of them by default) to its converted section.
+        '''
+        return scrub_text(html, self.config, targets,
+            defer_images=self._defer_images)
+
+    def scrub_stream(self, instream, outstream, targets=None):
+        '''
+        Scrubs the pages read from one stream into the other as they come, see
+        scrub_stream.
+        '''
+        scrub_stream(instream, outstream, self.config, targets)
+
+    def __repr__(self):
+        return 'Scrubber({})'.format(self.config_filename)
+
+
+def load_config(filename=CONFIG_FILENAME):
+    '''
+    Reads the config file, resolved against the program folder rather than the
+    current working directory.
+    '''
     config = configparser.ConfigParser()
-    config.read('config.ini')
+    config.read(resolve_path(filename))
+    return config
+
+def execute():
+    config = load_config()
 
     parser = argparse.ArgumentParser(
         description='Custom script to parse old Math Emporium files',
         epilog='With no target specified, then all sections are parsed')
 
-    parser.add_argument('filename', type=str,
+    parser.add_argument('filename', type=str, nargs='?',
         help='The file name located in the "raw" directory.')
 
-    parser.add_argument('-discussion', dest='targets', action='append_const',
+    parser.add_argument('-batch', action='store_true',
+        help='Treat the file name as a directory, glob, or file listing pages, '
+        'and scrub every page found in parallel.')
+    parser.add_argument('-stream', '-s', action='store_true',
+        help='Read the page from standard input (or the given file) in chunks '
+        'and write the sections to standard output as they are converted.')
+    parser.add_argument('-output', type=str, default=None,
+        help='Write the sections into this zip or tar archive (.zip, .tar, '
+        '.tar.gz, ...) or SQLite database (.sqlite, .db) instead of the output '
+        'folder.')
+    parser.add_argument('-precompress', action='store_true',
+        help='Also write each section of the output folder under a name '
+        'holding its content hash, with gzip (and brotli, if installed) '
+        'compressed copies, and list them in the assets.json of the page.')
+    parser.add_argument('-watch', action='store_true',
+        help='Keep running, and scrub the pages of the file name (a batch '
+        'source, the raw folder by default) again whenever they change. '
+        'Changes to the config, template, or transcriptions are picked up too.')
+    parser.add_argument('-interval', type=float, default=DEFAULT_INTERVAL,
+        help='How often, in seconds, to look for changes in watch mode.')
+    parser.add_argument('-workers', '-w', type=int, default=None,
+        help='Number of processes used in batch mode (default is the number of '
+        'cores).')
+
+    parser.add_argument('-discussion', '-d', dest='targets', action='append_const',
         const='discussion',
         help='Flag to specifically parse the topic discussion.')
     parser.add_argument('-examples', dest='targets', action='append_const',
         const='examples', help='Flag to specifically parse the examples.')
-    parser.add_argument('-problem', dest='targets', action='append_const',
+    parser.add_argument('-problem', '-p', dest='targets', action='append_const',
         const='problem', help='Flag to specifically parse the section problem.')
 
-    parser.add_argument('-interactive', action='store_true', 
+    image_modes = parser.add_mutually_exclusive_group()
+    image_modes.add_argument('-interactive', '-i', action='store_true', 
         help='Switch the program to interactive mode.')
-    parser.add_argument('-verbose', action='store_true',
+    image_modes.add_argument('-defer', '-de', action='store_true',
+        help='Write a placeholder for every image not yet typeset and queue it '
+        'for a later transcription session.')
+    image_modes.add_argument('-transcribe', '-t', action='store_true',
+        help='Typeset the queued images interactively and patch them into the '
+        'outputs. No file name is needed.')
+    parser.add_argument('-verbose', '-v', action='store_true',
         help='Set the logger level to debug (default is info) after startup.')
+    parser.add_argument('-nocache', action='store_true',
+        help='Ignore the cached section positions and converted sections, and '
+        'rediscover and convert them.')
+    parser.add_argument('-force', action='store_true',
+        help='Rebuild every target, even if none of its inputs changed.')
+    parser.add_argument('-tokenizer', type=str, default=None,
+        choices=tokenizer_names(),
+        help='The tokenizer backend to read the html with (default is the '
+        'tokenizer option of config.ini).')
+    parser.add_argument('-difftokenizers', action='store_true',
+        help='Scrub the page (or batch of pages) in memory with every '
+        'tokenizer backend and report any difference in the outputs. Nothing '
+        'is written.')
+    parser.add_argument('-diffpasses', action='store_true',
+        help='Scrub the page (or batch of pages) in memory both in a single '
+        'pass and from the section positions, as when they are cached, and '
+        'report any difference in the outputs. Nothing is written.')
+    parser.add_argument('-verify', action='store_true',
+        help='Scrub the page (or batch of pages) in memory and compare every '
+        'section against the golden set, showing a diff of the ones that '
+        'differ. Nothing is written.')
+    parser.add_argument('-record', action='store_true',
+        help='Scrub the page (or batch of pages) in memory and record the '
+        'sections as the new golden set.')
+    parser.add_argument('-golden', type=str, default=golden.GOLDEN_FOLDER,
+        help='The folder holding the golden set (default is "golden").')
+    parser.add_argument('-stats', action='store_true',
+        help='Time each stage and count what was processed, then print a '
+        'table of the results.')
+    parser.add_argument('-statsfile', type=str, default=None,
+        help='Like -stats, but write the results as json to this file.')
+    parser.add_argument('-trace', action='store_true',
+        help='Record the recent parser events, and log them along with any '
+        'error (or when the process receives SIGUSR1).')
+    parser.add_argument('-tracefile', type=str, default=None,
+        help='Like -trace, but also write the recorded events to this file at '
+        'the end.')
 
     args = parser.parse_args()
+    if args.filename is None and not (args.transcribe or args.stream or args.watch):
+        parser.error('the filename is required')
+    if not args.output is None and (args.defer or args.stream):
+        parser.error('-output cannot be used with -defer or -stream')
+    if args.precompress and (args.defer or args.stream or not args.output is None):
+        parser.error('-precompress cannot be used with -defer, -stream, or -output')
     
     logging.getLogger().setLevel(logging.INFO)
     if args.verbose:
         logging.getLogger().setLevel(logging.DEBUG)
-    logging.info('Scrubbing file "raw/{}.html"'.format(args.filename))
 
-    scrub_file(args, config)
+    report_color_problems(config)
+    if not args.tokenizer is None:
+        config['DEFAULT']['tokenizer'] = args.tokenizer
+
+    args.trace = args.trace or not args.tracefile is None
+    if args.trace:
+        tracer = tracing.enable()
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: tracer.dump())
+
+    args.stats = args.stats or not args.statsfile is None
+    if not args.stats:
+        run(args, config)
+    else:
+        with stats.collect() as collected:
+            run(args, config)
+        if args.statsfile is None:
+            logging.info('Stats:\n{}'.format(collected.format_table()))
+        else:
+            collected.write_json(args.statsfile)
+
+    if not args.tracefile is None:
+        tracing.tracer.dump(args.tracefile)
+
+def run(args, config):
+    '''
+    Runs the mode selected by the command line arguments.
+    '''
+
+    if args.stream:
+        if args.filename is None:
+            scrub_stream(sys.stdin.buffer, sys.stdout, config, args.targets,
+                args.interactive)
+        else:
+            with open(resolve_path('raw', args.filename) + '.html', 'rb') as instream:
+                scrub_stream(instream, sys.stdout, config, args.targets,
+                    args.interactive)
+    elif args.difftokenizers:
+        pages = collect_pages(args.filename) if args.batch else [args.filename]
+        diff_tokenizers(pages, config, args.targets)
+    elif args.diffpasses:
+        pages = collect_pages(args.filename) if args.batch else [args.filename]
+        diff_passes(pages, config, args.targets)
+    elif args.verify or args.record:
+        pages = collect_pages(args.filename) if args.batch else [args.filename]
+        golden.verify_pages(pages, args, config)
+    elif args.transcribe:
+        logging.info('Starting transcription session')
+        typeset = transcribe_queue(image_queue_path(), config)
+        logging.info('Typeset {} images'.format(typeset))
+    elif args.watch:
+        watch_pages(args, config)
+    elif args.batch:
+        scrub_batch(args, config)
+    else:
+        logging.info('Scrubbing file "raw/{}.html"'.format(args.filename))
+        sink = open_sink(args.output, precompress=args.precompress)
+        try:
+            scrub_file(args, config, sink)
+        finally:
+            sink.close()
+
+def diff_tokenizers(pages, config, targets=None):
+    '''
+    Scrubs each page with every tokenizer backend and logs a diff of every
+    section that comes out differently than with the stdlib backend. Returns
+    the pages that differ.
+    '''
+
+    if not check_compare_tokenizers(config, targets):
+        raise RuntimeError('Comparing the tokenizers missed a backend that '
+            'differs on purpose')
+
+    differing = []
+    for page in pages:
+        with open(resolve_path('raw', page) + '.html', 'rb') as infile:
+            text = infile.read()
+
+        differences = compare_tokenizers(text, config, targets)
+        for name, target, diff in differences:
+            logging.error('Tokenizer {} differs on the {} of "{}":\n{}'.format(
+                name, target, page, ''.join(diff)))
+        if differences:
+            differing.append(page)
+
+    logging.info('Compared tokenizers on {} pages: {} identical, {} differ'.format(
+        len(pages), len(pages) - len(differing), len(differing)))
+    return differing
+
+def compare_tokenizers(text, config, targets=None):
+    '''
+    Returns a (tokenizer, target, unified diff lines) tuple for every section
+    of the page that some backend converts differently than the stdlib one.
+    '''
+
+    expected = scrub_text_or_error(text, config, targets, 'stdlib')
+    differences = []
+    for name in tokenizer_names():
+        if name == 'stdlib':
+            continue
+        outputs = scrub_text_or_error(text, config, targets, name)
+        for target, output in sorted(outputs.items()):
+            if output != expected[target]:
+                diff = list(difflib.unified_diff(
+                    expected[target].splitlines(True), output.splitlines(True),
+                    'stdlib', name))
+                differences.append((name, target, diff))
+
+    return differences
 
-def scrub_file(args, config):
+def check_compare_tokenizers(config, targets=None):
+    '''
+    Compares the backends on a small page with a backend that differs on
+    purpose registered as well, and returns whether that backend is reported.
+    Otherwise a comparison that is never really made (say, a backend served
+    the output of another from the section cache) would pass every page.
+    '''
+
+    TOKENIZERS['altered'] = AlteredTokenizer
+    try:
+        differences = compare_tokenizers(TOKENIZER_CHECK_PAGE, config, targets)
+    finally:
+        del TOKENIZERS['altered']
+    return any(name == 'altered' for name, target, diff in differences)
+
+def diff_passes(pages, config, targets=None):
+    '''
+    Scrubs each page both in a single pass and by parsing the byte range of
+    each section found by the first pass, as when the section positions are
+    cached, and logs a diff of every section that comes out differently.
+    Returns the pages that differ (or failed).
+    '''
+
+    differing = []
+    for page in pages:
+        try:
+            differences = compare_passes(resolve_path('raw', page) + '.html',
+                config, targets)
+        except Exception:
+            logging.error('Scrubbing "{}" failed:\n{}'.format(page,
+                traceback.format_exc()))
+            differing.append(page)
+            continue
+
+        for target, diff in differences:
+            logging.error('The passes differ on the {} of "{}":\n{}'.format(
+                target, page, ''.join(diff)))
+        if differences:
+            differing.append(page)
+
+    logging.info('Compared passes on {} pages: {} identical, {} differ'.format(
+        len(pages), len(pages) - len(differing), len(differing)))
+    return differing
+
+def compare_passes(filename, config, targets=None):
+    '''
+    Returns a (target, unified diff lines) tuple for every section of the file
+    that parse_section converts differently than the single pass. The section
+    cache is left out, so the passes themselves are compared.
+    '''
+
+    if targets is None:
+        targets = TARGETS
+    tokenizer = tokenizer_name(config)
+
+    buffers = [OutputBuffer() for target in TARGETS]
+    section_parsers = create_section_parsers(targets, buffers, False, config,
+        False)
+    with open(filename, 'rb') as infile:
+        positions = scrub_single_pass(infile, section_parsers, tokenizer)
+
+    differences = []
+    for target, parser_class, byte_range, buffer in zip(TARGETS, PARSER_CLASSES,
+            positions, buffers):
+        if not target in targets:
+            continue
+        section = OutputBuffer()
+        parse_section(parser_class, byte_range, filename, section, False, config)
+        if section.getvalue() != buffer.getvalue():
+            diff = list(difflib.unified_diff(buffer.getvalue().splitlines(True),
+                section.getvalue().splitlines(True), 'single pass',
+                'positions'))
+            differences.append((target, diff))
+
+    return differences
+
+def scrub_text_or_error(text, config, targets, tokenizer):
+    '''
+    Same as scrub_text, but an error becomes the output of every section, so
+    that backends failing alike compare equal.
+    '''
+    try:
+        return scrub_text(text, config, targets, tokenizer=tokenizer)
+    except Exception as e:
+        error = 'Error: {!r}\n'.format(e)
+        return {target: error for target in targets or TARGETS}
+
+def report_color_problems(config):
+    '''
+    Compiles the color table up front and logs every color that cannot be
+    converted, so the config can be fixed before any file is touched. Returns
+    the number of problems.
+    '''
+
+    colors = ColorTable.from_config(config)
+    problems = colors.problems()
+    for problem in problems:
+        logging.warning('Color config: {}'.format(problem))
+    for name in colors.unused:
+        logging.debug('Color config: mapping for {} is never used'.format(name))
+
+    return len(problems)
+
+def collect_pages(source):
+    '''
+    Resolves the batch source into a sorted list of page names. The source may
+    be a directory of html files, a glob pattern, or a file listing one page
+    per line (blank lines and lines starting with # are skipped). Either way,
+    the pages themselves are always read from the "raw" directory.
+    '''
+
+    if os.path.isdir(source):
+        entries = glob.glob(os.path.join(source, '*.html'))
+    elif os.path.isfile(source) and not source.endswith('.html'):
+        with open(source) as listfile:
+            entries = [line.strip() for line in listfile]
+            entries = [entry for entry in entries
+                if entry and not entry.startswith('#')]
+    else:
+        entries = glob.glob(source)
+
+    pages = set()
+    for entry in entries:
+        name = os.path.basename(entry)
+        if name.endswith('.html'):
+            name = name[:-5]
+        pages.add(name)
+
+    return sorted(pages)
+
+def scrub_page(page, args, config, existing=None, stored=None):
+    '''
+    Scrubs a single page on its own, so that a failure only affects this page.
+    Returns a PageResult of the page, the time it took, whether the section
+    positions were cached (None if every target was up to date, see
+    scrub_file), the formatted traceback of the error (or None on
+    success), the stats of the page as a dictionary (or None unless stats are
+    collected), and the outputs. When tracing, the error includes the events
+    that led to it.
+
+    The sections are written to the output folder, unless the targets already
+    in another sink are given as existing, along with the state it stored for
+    the page. The (target, text) of each section to write is then returned in
+    the outputs, and the (name, data) of the state to keep in the state, to be
+    written by the caller.
+    '''
+
+    page_args = argparse.Namespace(**vars(args))
+    page_args.filename = page
+    if getattr(args, 'trace', False):
+        # Workers do not necessarily inherit the tracer of the main process
+        if tracing.tracer is None:
+            tracing.enable()
+        tracing.tracer.clear()
+    sink = None if existing is None else MemorySink(existing, stored)
+    start = time.perf_counter()
+    cached = False
+    page_stats = None
+    try:
+        if not getattr(args, 'stats', False):
+            cached = scrub_file(page_args, config, sink)
+        else:
+            # Collected apart from the batch, since workers are other processes
+            with stats.collect() as collected:
+                cached = scrub_file(page_args, config, sink)
+            page_stats = collected.as_dict()
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+        if not tracing.tracer is None:
+            error += 'Last parser events:\n{}\n'.format(tracing.tracer.format())
+
+    outputs = None if sink is None else sink.outputs
+    state = None if sink is None else sink.state
+    return PageResult(page, time.perf_counter() - start, cached, error,
+        page_stats, outputs, state)
+
+def scrub_batch(args, config):
+    '''
+    Fans the pages of the batch source out across a process pool. Interactive
+    mode needs the console, so in that case the pages are scrubbed serially.
+    With an output archive or database, the workers hand their sections back
+    and only this process writes to it. Returns the list of results from
+    scrub_page.
+    '''
+
+    pages = collect_pages(args.filename)
+    logging.info('Scrubbing {} pages from "{}"'.format(len(pages), args.filename))
+
+    sink = None if getattr(args, 'output', None) is None else open_sink(args.output)
+    start = time.perf_counter()
+    try:
+        if args.interactive:
+            results = scrub_serially(pages, args, config, sink)
+        else:
+            with ProcessPoolExecutor(max_workers=args.workers) as executor:
+                futures = [executor.submit(scrub_page, page, args, config,
+                    existing_targets(sink, page), stored_state(sink, page))
+                    for page in pages]
+                results = [store_outputs(sink, future.result())
+                    for future in futures]
+    finally:
+        if not sink is None:
+            sink.close()
+    elapsed = time.perf_counter() - start
+
+    collected = stats.current()
+    if not collected is None:
+        for result in results:
+            if not result.stats is None:
+                collected.merge(result.stats)
+
+    report_batch(results, elapsed)
+    return results
+
+def watch_pages(args, config):
+    '''
+    Scrubs the pages of the batch source (the raw folder by default), then
+    keeps running and scrubs again whatever pages change, in this process, so
+    the config, color table, and template stay loaded. The manifest of each
+    page limits the work to the sections whose inputs changed. A change to the
+    config reloads it; a change to it, the template, or the transcriptions
+    goes over every page, since any of them may be affected.
+    '''
+
+    source = resolve_path('raw') if args.filename is None else args.filename
+    config_filename = resolve_path(CONFIG_FILENAME)
+
+    def list_pages():
+        return {page: resolve_path('raw', page) + '.html'
+            for page in collect_pages(source)}
+
+    def list_files():
+        defaults = config['DEFAULT']
+        return [config_filename,
+            resolve_path(defaults.get('problem_template', DEFAULT_TEMPLATE_FILENAME)),
+            resolve_path(defaults.get('transcription_file',
+                DEFAULT_TRANSCRIPTION_FILENAME))]
+
+    watcher = Watcher(list_pages, list_files, args.interval)
+    sink = None if args.output is None else open_sink(args.output)
+    pages = sorted(list_pages())
+    logging.info('Watching {} pages from "{}" ({})'.format(len(pages), source,
+        watcher))
+
+    try:
+        while True:
+            start = time.perf_counter()
+            results = scrub_serially(pages, args, config, sink)
+            if not sink is None:
+                sink.commit()
+            report_batch(results, time.perf_counter() - start)
+
+            pages, files = watcher.wait()
+            logging.info('Changed: {}'.format(', '.join(files + pages)))
+            if config_filename in files:
+                logging.info('Reloading {}'.format(config_filename))
+                config = load_config()
+                if not args.tokenizer is None:
+                    config['DEFAULT']['tokenizer'] = args.tokenizer
+                report_color_problems(config)
+            if files:
+                pages = sorted(list_pages())
+    except KeyboardInterrupt:
+        logging.info('Stopped watching')
+    finally:
+        if not sink is None:
+            sink.close()
+
+def scrub_serially(pages, args, config, sink=None):
+    '''
+    Scrubs the pages one at a time in this process. Returns their results.
+    '''
+    return [store_outputs(sink, scrub_page(page, args, config,
+        existing_targets(sink, page), stored_state(sink, page)))
+        for page in pages]
+
+def existing_targets(sink, page):
+    '''
+    Returns the targets of the page already in the sink, or None for the
+    output folder, which the workers write to themselves.
+    '''
+    if sink is None:
+        return None
+    return [target for target in TARGETS if sink.exists(page, target)]
+
+def stored_state(sink, page):
+    '''
+    Returns the manifest and section positions the sink holds for the page, or
+    None for the output folder.
+    '''
+    if sink is None:
+        return None
+    stored = {}
+    for name in [MANIFEST_FILENAME, POSITION_CACHE_FILENAME]:
+        data = sink.read_state(page, name)
+        if not data is None:
+            stored[name] = data
+    return stored
+
+def store_outputs(sink, result):
+    '''
+    Writes the sections and state a worker handed back to the sink. Returns
+    the result.
+    '''
+    if not sink is None and not result.outputs is None:
+        for target, text in result.outputs:
+            with stats.stage('write'):
+                written = sink.write(result.page, target, text)
+            stats.count('outputs written' if written else 'outputs unchanged')
+    if not sink is None and not result.state is None:
+        for name, data in result.state:
+            sink.write_state(result.page, name, data)
+    return result
+
+def report_batch(results, elapsed):
+    '''
+    Logs the outcome and time of every page in the batch, followed by a
+    summary of the successes and failures.
+    '''
+
+    failures = [result for result in results if not result.error is None]
+    succeeded = [result for result in results if result.error is None]
+    hits = sum(1 for result in succeeded if result.cached is True)
+    misses = sum(1 for result in succeeded if result.cached is False)
+
+    for result in results:
+        status = 'ok' if result.error is None else 'FAILED'
+        logging.info('{:<30} {:>8.3f}s  {}'.format(result.page, result.seconds,
+            status))
+
+    for result in failures:
+        logging.error('Scrubbing "{}" failed:\n{}'.format(result.page,
+            result.error))
+
+    logging.info('Position cache: {} hits, {} misses, {} pages up to date'.format(
+        hits, misses, len(succeeded) - hits - misses))
+    logging.info('Batch finished in {:.3f}s: {} succeeded, {} failed'.format(
+        elapsed, len(results) - len(failures), len(failures)))
+
+def scrub_file(args, config, sink=None):
     '''
     Goes through the process of setting up the files to write to then converting
-    the original file.
+    the original file. Targets whose inputs did not change since they were last
+    built (according to the manifest of the page) are skipped. If the section
+    positions of the file are cached from a previous run, only the sections are
+    read. Otherwise, the file is scrubbed in a single pass and the discovered
+    positions are cached. Each section is collected in memory and written to
+    its file in one go once the page is done, skipping the files whose content
+    is unchanged. The sections go to the sink if given (see sinks) instead of
+    the output folder, and so do the manifest and the cached positions.
+    Returns whether the position cache was hit, or None if every target was up
+    to date, so the page was not read at all.
     '''
 
     # Get absolute paths for the files
-    filenames = prepare_folder(args.filename)
+    filenames = page_filenames(args.filename)
     filename, outputfilenames = filenames[0], filenames[1:]
+    if sink is None:
+        sink = open_sink(precompress=getattr(args, 'precompress', False))
+    sink.prepare(args.filename)
     
-    # First pass: get the sections dedicated to discussion, examples, and
-    # problems
-    logging.info('Determining section locations for {}'.format(filename))
-    parser = FirstPassParser()
-
-    with open(filename) as f:
-        parser.feed(f.read())
-
-    positions = parser.positions
-    logging.info('File Sections Discovered in line sections {}'.format(positions))
-
-    # Second pass: for each position set, iterate through the original file and
-    # write the appropriate contents using the second pass parser to the new
-    # file
-    targets = ['discussion', 'examples', 'problem']
-    parser_classes = [TopicDiscussionParser, ExampleParser, ProblemParser]
+    targets = TARGETS
+    parser_classes = PARSER_CLASSES
 
     if args.targets is None:
         args.targets = targets
-        
-    for target, parser_class, line_range, ofilename in zip(targets, parser_classes, positions, outputfilenames):
+
+    collected = stats.current()
+    if not collected is None:
+        collected.count('pages')
+        collected.count('bytes read', os.path.getsize(filename))
+    with stats.stage('hash'):
+        digest = hash_file(filename)
+    with stats.stage('manifest'):
+        manifest = BuildManifest(sink, args.filename)
+    mode = image_mode(args)
+
+    # Only build the targets whose inputs changed
+    build_targets = []
+    for target, parser_class, ofilename in zip(targets, parser_classes, outputfilenames):
         if target in args.targets:
-            logging.info('Parsing {}...'.format(target))
-            parse_section(parser_class, line_range, filename, ofilename, args.interactive, config)
+            if not args.force and sink.exists(args.filename, target) and \
+                    manifest.is_current(target, digest, parser_class, config, mode):
+                logging.info('Skipping {}, its inputs are unchanged'.format(target))
+                stats.count('targets skipped')
+            else:
+                build_targets.append(target)
+
+    if not build_targets:
+        return None
+
+    positions = None
+    if not args.nocache:
+        positions = load_cached_positions(sink, args.filename, digest)
+    cached = not positions is None
+    stats.count('position cache hits' if cached else 'position cache misses')
+    stats.count('targets built', len(build_targets))
+
+    # Converted sections are reused across pages, unless a person is asked
+    # about the images or the caches are to be ignored
+    cache = None
+    if not (args.interactive or args.nocache):
+        cache = shared_cache(config)
+
+    buffers = [OutputBuffer() for target in targets]
+    if cached:
+        logging.info('Position cache hit: byte ranges {}'.format(positions))
+        section_parsers = []
+        for target, parser_class, byte_range, buffer in zip(targets, parser_classes, positions, buffers):
+            if target in build_targets:
+                logging.info('Parsing {}...'.format(target))
+                section_parsers.append(parse_section(parser_class, byte_range,
+                    filename, buffer, args.interactive, config, args.defer,
+                    cache, mode))
+            else:
+                section_parsers.append(None)
+    else:
+        logging.info('Position cache miss for {}'.format(filename))
+        section_parsers = create_section_parsers(build_targets, buffers,
+            args.interactive, config, args.defer)
+        with open(filename, 'rb') as infile:
+            positions = scrub_single_pass(infile, section_parsers,
+                tokenizer_name(config), cache, buffers, config, mode)
+        store_cached_positions(sink, args.filename, digest, positions)
+
+    for target, section_parser, buffer, ofilename in zip(targets, section_parsers, buffers, outputfilenames):
+        if not section_parser is None:
+            with stats.stage('write'):
+                written = sink.write(args.filename, target, buffer.getvalue())
+            if not written is None:
+                stats.count('outputs written' if written else 'outputs unchanged')
+            with stats.stage('manifest'):
+                manifest.record(target, digest, section_parser, config, mode)
+            queue_images(image_queue_path(), ofilename,
+                section_parser.deferred_images)
+    with stats.stage('manifest'):
+        manifest.save()
+
+    return cached
+
+def scrub_text(text, config, targets=None, interactive=False, defer_images=False,
+        tokenizer=None):
+    '''
+    Scrubs a whole page given as a string (or bytes) in memory, without
+    touching the raw or output directories. Returns a dictionary from each
+    target to its converted section. The tokenizer backend defaults to the one
+    of the config.
+    '''
+
+    if targets is None:
+        targets = TARGETS
+    if tokenizer is None:
+        tokenizer = tokenizer_name(config)
+
+    buffers = [OutputBuffer() for target in TARGETS]
+    section_parsers = create_section_parsers(targets, buffers, interactive,
+        config, defer_images)
 
-def parse_section(parser_class, line_range, filename, outputfilename, interactive, config):
-    start_line, end_line = line_range
-    with open(filename) as infile, open(outputfilename, 'w') as outfile:
-        parser = parser_class(outfile, interactive, config)
-        for line_number, line in enumerate(infile):
-            if start_line <= line_number <= end_line:
-                parser.feed(line)
+    cache = None if interactive else shared_cache(config)
+    if isinstance(text, str):
+        lines = io.StringIO(text, newline='\n')
+    else:
+        lines = io.BytesIO(text)
+    scrub_single_pass(lines, section_parsers, tokenizer, cache, buffers, config,
+        'defer' if defer_images else 'default')
+    stats.count('pages')
+
+    return {target: buffer.getvalue()
+        for target, buffer in zip(TARGETS, buffers) if target in targets}
 
-def prepare_folder(foldername):
+def scrub_stream(instream, outstream, config, targets=None, interactive=False,
+        chunk_size=CHUNK_SIZE):
     '''
-    Just makes sure a folder with given name exists in the output directory.
-    Furthermore, even if the folder exists, returns a tuple containing the
-    filenames to write to: discussion, examples, problems.
+    Scrubs pages read from any file-like object (text or binary) in fixed size
+    chunks, writing each section to the output stream as it is converted. The
+    input may hold several pages one after the other.
     '''
 
-    basepath = os.path.realpath(os.path.dirname(__file__))
-    dirpath = os.path.join(basepath, 'output', foldername)
-    filename = os.path.join(basepath, 'raw', foldername) + '.html'
+    if targets is None:
+        targets = TARGETS
+
+    parser = StreamingParser(outstream, targets, interactive, config)
+    with stats.stage('parse'):
+        for line in iter_chunked_lines(instream, chunk_size):
+            parser.feed_line(line)
+        parser.finish()
+
+def iter_chunked_lines(stream, chunk_size=CHUNK_SIZE):
+    '''
+    Reads the stream in fixed size chunks and yields it line by line, ending a
+    line at a newline, a Windows line ending, or a lone carriage return. A
+    binary stream is decoded as it is read, so a character is never cut in two
+    by the end of a chunk. A line longer than a chunk is yielded in pieces to
+    keep memory bounded, so its text may reach the section parsers in more
+    chunks than when reading a file.
+    '''
+
+    decoder = codecs.getincrementaldecoder(ENCODING)()
+    pending = ''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        if isinstance(chunk, bytes):
+            chunk = decoder.decode(chunk)
+            if not chunk:
+                continue
+
+        # A carriage return that ended the previous chunk is a line ending of
+        # its own, unless this chunk goes on with the newline
+        if pending.endswith('\r') and not chunk.startswith('\n'):
+            yield pending
+            pending = ''
+
+        start = 0
+        end = find_line_end(chunk, start, len(chunk))
+        while end != -1 and not (end == len(chunk) and chunk.endswith('\r')):
+            yield pending + chunk[start:end]
+            pending = ''
+            start = end
+            end = find_line_end(chunk, start, len(chunk))
+
+        pending += chunk[start:]
+        if len(pending) >= chunk_size and not pending.endswith('\r'):
+            yield pending
+            pending = ''
+
+    # Fails on a character left incomplete at the end of the stream
+    pending += decoder.decode(b'', True)
+    if pending:
+        yield pending
+
+def create_section_parsers(targets, writers, interactive, config, defer_images):
+    '''
+    Creates the parser of each requested section, writing to the writer of the
+    section. Sections that are not requested get None.
+    '''
+
+    section_parsers = []
+    for target, parser_class, writer in zip(TARGETS, PARSER_CLASSES, writers):
+        if target in targets:
+            logging.info('Parsing {}...'.format(target))
+            section_parsers.append(parser_class(writer, interactive, config,
+                defer_images))
+        else:
+            section_parsers.append(None)
+
+    return section_parsers
 
-    if not os.path.exists(dirpath):
-        logging.info('Creating directory {}'.format(dirpath))
-        os.mkdir(dirpath)
+def scrub_single_pass(lines, section_parsers, tokenizer=DEFAULT_TOKENIZER,
+        cache=None, writers=None, config=None, image_mode='default'):
+    '''
+    Single pass: walks the lines of the original file once, letting the
+    sections route themselves to the appropriate parser. Returns the
+    positions of the sections. With a section cache, the sections are looked
+    up in it first (see CachingSinglePassParser), and the writers of the
+    sections and the config must be given.
+    '''
+
+    if cache is None:
+        parser = SinglePassParser(section_parsers, tokenizer)
     else:
-        logging.warn('Directory already exists. Will overwrite files')
+        parser = CachingSinglePassParser(section_parsers, writers, cache, config,
+            image_mode, tokenizer)
+
+    # Feed line by line so the section parsers see the same data chunks as
+    # they would from parse_section
+    with stats.stage('parse'):
+        for line in lines:
+            parser.feed_line(line)
+        parser.finish()
+
+    logging.info('File Sections Discovered in byte ranges {}'.format(parser.positions))
+    return parser.positions
+
+def image_mode(args):
+    '''
+    Returns how images are handled: 'interactive', 'defer', or 'default'.
+    '''
+    if args.interactive:
+        return 'interactive'
+    elif args.defer:
+        return 'defer'
+    return 'default'
+
+def image_queue_path():
+    return resolve_path('output', IMAGE_QUEUE_FILENAME)
+
+def load_cached_positions(sink, page, digest):
+    '''
+    Returns the section positions the sink holds for a page whose raw file has
+    the given digest, or None if there are none (or they are stale).
+    '''
+
+    cached = sink.read_state(page, POSITION_CACHE_FILENAME)
+    if cached is None:
+        return None
+
+    if cached.get('version') != POSITION_CACHE_VERSION or cached.get('hash') != digest:
+        return None
+
+    return cached['positions']
+
+def store_cached_positions(sink, page, digest, positions):
+    sink.write_state(page, POSITION_CACHE_FILENAME, {
+        'version': POSITION_CACHE_VERSION,
+        'hash': digest,
+        'positions': positions})
+
+def index_sections(filename, tokenizer=DEFAULT_TOKENIZER):
+    '''
+    Runs only the first pass over the file, returning the byte range of each
+    section.
+    '''
+
+    parser = FirstPassParser(tokenizer)
+    with open(filename, 'rb') as infile:
+        for line in infile:
+            parser.feed_line(line)
+
+    logging.info('File Sections Discovered in byte ranges {}'.format(parser.positions))
+    return parser.positions
+
+def parse_section(parser_class, byte_range, filename, writer, interactive, config,
+        defer_images=False, cache=None, image_mode='default'):
+    '''
+    Feeds only the given [start, end) byte range of the original file to a new
+    section parser writing to the writer (such as an OutputBuffer). The file is
+    memory mapped, so only the bytes of the section are ever read and decoded.
+    A section never closed (end is -1) runs to the end of the file, as in the
+    single pass. With a section cache, the section is looked up in it first,
+    and the writer must be a fresh OutputBuffer. Returns the section parser.
+    '''
+    start, end = byte_range
+    parser = parser_class(writer, interactive, config, defer_images)
+    if start < 0:
+        return parser
+    tokenizer = tokenizer_name(config)
+    source = event_source(parser, tokenizer)
+
+    def convert():
+        feed_section(source, data, view, start, end)
+        parser.end_section()
+
+    with open(filename, 'rb') as infile, \
+            mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as data, \
+            memoryview(data) as view, \
+            stats.stage('parse'):
+        if end < 0:
+            end = len(data)
+        if cache is None:
+            convert()
+        else:
+            convert_cached(cache, parser, writer, data[start:end], convert,
+                config, config_digest(config), image_mode, tokenizer)
+
+    return parser
+
+def feed_section(source, data, view, start, end):
+    '''
+    Feeds the [start, end) byte range of the data to the event source. Still
+    feeds line by line to keep the same data chunks.
+    '''
+    line_start = start
+    while line_start < end:
+        line_end = find_line_end(data, line_start, end)
+        if line_end == -1:
+            line_end = end
+        source.feed(decode_line(view[line_start:line_end]))
+        line_start = line_end
+
+def convert_cached(cache, parser, writer, data, convert, config, config_hash,
+        image_mode, tokenizer):
+    '''
+    Writes the output the section cache holds for a section with the raw bytes
+    data, read with the named tokenizer backend, to the writer, restoring the
+    section parser. On a miss, calls convert
+    to have the section parser do the work, and stores its output. Returns
+    whether the output came from the cache.
+    '''
+    key = section_key(section_digest(data), type(parser), config_hash,
+        image_mode, tokenizer)
+    section = cache.lookup(key, config)
+    if section is None:
+        convert()
+        cache.store(key, parser, writer.getvalue(), config)
+        stats.count('sections converted')
+        return False
+
+    section.restore(parser, writer)
+    stats.count('sections reused')
+    return True
+
+def decode_line(line):
+    '''
+    Decodes a raw line (any bytes-like object) as reading the file in text mode
+    would, translating Windows and old Mac line endings. Lines that are
+    already strings only have their line endings translated.
+    '''
+    if not isinstance(line, str):
+        line = str(line, ENCODING)
+    if '\r' in line:
+        line = line.replace('\r\n', '\n').replace('\r', '\n')
+    return line
+
+def find_line_end(data, start, end):
+    '''
+    Returns the offset just past the first line ending in data[start:end], be
+    it a newline, a Windows line ending, or a lone carriage return, or -1 if
+    there is none. The data is a string, bytes, or a memory map.
+    '''
+    newline, cr = ('\n', '\r') if isinstance(data, str) else (b'\n', b'\r')
+    found = data.find(newline, start, end)
+    carriage = data.find(cr, start, end if found == -1 else found)
+    if carriage == -1:
+        return found if found == -1 else found + 1
+    if carriage + 1 == found:
+        return found + 1
+    return carriage + 1
+
+def split_lines(line):
+    '''
+    Splits a raw line (a string or bytes) at the lone carriage returns it
+    holds, as reading the file in text mode would. Returns the pieces, line
+    endings included.
+    '''
+    if not ('\r' if isinstance(line, str) else b'\r') in line:
+        return (line,)
+
+    parts = []
+    start = 0
+    while start < len(line):
+        end = find_line_end(line, start, len(line))
+        if end == -1:
+            end = len(line)
+        parts.append(line[start:end])
+        start = end
+    return parts
+
+def page_filenames(foldername):
+    '''
+    Returns a tuple containing the raw file of the page, followed by the files
+    its sections are written to in the output directory: discussion, examples,
+    problems.
+    '''
+
+    dirpath = resolve_path('output', foldername)
+    filename = resolve_path('raw', foldername) + '.html'
 
     filenamebuilder = lambda x: os.path.join(dirpath, x) + '.html'
     outputs = tuple(map(filenamebuilder, ['discussion', 'examples', 'problem']))
@@ -165,3 +1401,5 @@ if __name__ == '__main__':
         execute()
     except Exception as e:
         logging.exception('Scrubber encountered error. Exiting.')
+        if not tracing.tracer is None:
+            tracing.tracer.dump()
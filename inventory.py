@@ -0,0 +1,333 @@
+#!/usr/bin/python3
+'''
+module inventory
+
+A read-only pre-scan of the whole raw corpus. Every page is only tokenized,
+not converted, in parallel across processes, and the findings are combined
+into one report: how often each tag and tag.class appears, every distinct
+color hex value (and what it maps to), every image referenced along with how
+often it is reused, and the pages that would fail to scrub. A page fails on a
+span color missing from the config, a closed tag no section parser supports
+(its end tag would close the converter of the enclosing tag), a missing
+p1/p2/p3 section, an example id without the example and part numbers, or an
+end tag closing more than the section opened. Unsupported tags that are never
+closed, such as <br>, are skipped by the parsers and only listed. Nothing is
+written except the report.
+'''
+
+import argparse
+import collections
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import json
+import logging
+import os
+import re
+
+from example import ExampleParser
+import htmlscrubber
+from htmlparse import ColorTable, CustomHTMLParser
+from storage import resolve_path
+from tokenizers import tokenizer_name, tokenizer_names
+from transcriptions import TranscriptionStore, image_path
+
+DEFAULT_REPORT_FILENAME = 'inventory.json'
+
+# Tag rule factories which read the example and part numbers from the id
+ID_FACTORIES = {ExampleParser.start_hint, ExampleParser.continue_example,
+    ExampleParser.start_part}
+
+# Tag rule factories which handle the tag without a converter, so its end
+# tag closes the enclosing one instead
+UNCONVERTED_FACTORIES = {CustomHTMLParser.convert_image,
+    ExampleParser.continue_example}
+
+
+class InventoryParser(htmlscrubber.FirstPassParser):
+    '''
+    Finds the sections like the first pass, and takes stock of the tags inside
+    them. The section parsers are never created; instead, each tag is matched
+    against their tag rules to find what would go wrong. Sections whose parser
+    handles the tags itself (the problem) are only counted.
+    '''
+
+    def __init__(self, config, tokenizer):
+        super(InventoryParser, self).__init__(tokenizer)
+        self._colors = ColorTable.from_config(config)
+
+        self.tags = collections.Counter()
+        self.classes = collections.Counter()
+        self.colors = collections.Counter()
+        self.images = collections.Counter()
+        self.unsupported = collections.Counter()
+        self.skipped = collections.Counter()
+        self.failures = []
+
+        # The unsupported tags of each section still waiting for an end tag
+        self._unclosed = [collections.Counter() for i in range(3)]
+
+        # The converters open in each section, or None once it has failed
+        self._depths = [0, 0, 0]
+
+    def fail(self, message):
+        self.failures.append('line {}: {}'.format(self._source.getpos()[0],
+            message))
+
+    def section_rules(self, i):
+        '''
+        Returns the tag rules of the parser of section i, or None if it does
+        not convert through tag rules.
+        '''
+        tag_rules = htmlscrubber.PARSER_CLASSES[i].tag_rules
+        if tag_rules is CustomHTMLParser.tag_rules:
+            return None
+        return tag_rules
+
+    def handle_starttag(self, tag, attrs):
+        super(InventoryParser, self).handle_starttag(tag, attrs)
+        i = self.current_section()
+        if i == -1:
+            return
+
+        self.tags[tag] += 1
+        for attr, value in attrs:
+            if attr == 'class':
+                self.classes['{}.{}'.format(tag, value)] += 1
+            elif attr == 'src' and tag == 'img':
+                self.images[value] += 1
+
+        tag_rules = self.section_rules(i)
+        if tag_rules is None:
+            return
+
+        factory = tag_rules.match(tag, attrs)
+        if factory is None:
+            # Only a failure once its end tag shows up
+            self._unclosed[i][tag] += 1
+            return
+
+        if factory is CustomHTMLParser.convert_span:
+            self.check_color(attrs)
+        elif factory in ID_FACTORIES:
+            self.check_id(tag, attrs)
+
+        if not factory in UNCONVERTED_FACTORIES and not self._depths[i] is None:
+            self._depths[i] += 1
+
+    def handle_endtag(self, tag):
+        # The closing division belongs to the section
+        i = self.current_section()
+        super(InventoryParser, self).handle_endtag(tag)
+        if i == -1 or self.section_rules(i) is None:
+            return
+
+        if self._unclosed[i][tag] > 0:
+            self._unclosed[i][tag] -= 1
+            self.unsupported['{} {}'.format(htmlscrubber.TARGETS[i], tag)] += 1
+            self.fail('unsupported tag <{}> in the {} is closed'.format(tag,
+                htmlscrubber.TARGETS[i]))
+
+        if self._depths[i] is None:
+            return
+
+        if self._depths[i] == 0:
+            self.fail('</{}> closes more than the {} opened'.format(tag,
+                htmlscrubber.TARGETS[i]))
+            self._depths[i] = None
+        else:
+            self._depths[i] -= 1
+
+    def check_color(self, attrs):
+        for attr, value in attrs:
+            if attr == 'style':
+                old_color_hex = (value or '')[7:].lower()
+                if old_color_hex == '':
+                    return
+                self.colors[old_color_hex] += 1
+                try:
+                    self._colors.lookup(old_color_hex)
+                except KeyError as e:
+                    self.fail('span color {}: {}'.format(old_color_hex, e.args[0]))
+                return
+
+    def check_id(self, tag, attrs):
+        for attr, value in attrs:
+            if attr == 'id':
+                if len(re.findall(r'\d+', value or '')) != 2:
+                    self.fail('<{}> id "{}" does not hold the example and part '
+                        'numbers'.format(tag, value))
+                return
+        self.fail('<{}> has no id'.format(tag))
+
+    def check_sections(self):
+        for target, unclosed in zip(htmlscrubber.TARGETS, self._unclosed):
+            for tag, count in unclosed.items():
+                if count > 0:
+                    self.skipped['{} {}'.format(target, tag)] += count
+
+        for target, (start, end) in zip(htmlscrubber.TARGETS, self.positions):
+            if start == -1:
+                self.failures.append('missing the {} section'.format(target))
+            elif end == -1:
+                self.failures.append('the {} section is never closed'.format(
+                    target))
+
+
+def scan_page(page, config):
+    '''
+    Tokenizes the raw page, returning what was found as a dictionary.
+    '''
+
+    filename = resolve_path('raw', page) + '.html'
+    parser = InventoryParser(config, tokenizer_name(config))
+    size = 0
+    try:
+        with open(filename, 'rb') as infile:
+            for line in infile:
+                parser.feed_line(line)
+                size += len(line)
+        parser.check_sections()
+    except Exception as e:
+        parser.failures.append('cannot be read: {!r}'.format(e))
+
+    return {
+        'page': page,
+        'bytes': size,
+        'tags': parser.tags,
+        'classes': parser.classes,
+        'colors': parser.colors,
+        'images': parser.images,
+        'unsupported': parser.unsupported,
+        'skipped': parser.skipped,
+        'failures': parser.failures
+    }
+
+def scan_pages(pages, config, workers=None):
+    '''
+    Scans the pages across a process pool, returning their findings in order.
+    '''
+    # Pages are small, so hand them out a few at a time
+    chunksize = max(1, len(pages) // (4 * (workers or os.cpu_count() or 1)))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(scan_page, pages, itertools.repeat(config),
+            chunksize=chunksize))
+
+def build_report(findings, config):
+    '''
+    Combines the findings of the pages into the report.
+    '''
+
+    tags = collections.Counter()
+    classes = collections.Counter()
+    unsupported = collections.Counter()
+    skipped = collections.Counter()
+    colors = collections.Counter()
+    images = collections.Counter()
+    color_pages = collections.defaultdict(list)
+    image_pages = collections.defaultdict(list)
+    failing = {}
+    for found in findings:
+        tags.update(found['tags'])
+        classes.update(found['classes'])
+        unsupported.update(found['unsupported'])
+        skipped.update(found['skipped'])
+        colors.update(found['colors'])
+        images.update(found['images'])
+        for old_color_hex in found['colors']:
+            color_pages[old_color_hex].append(found['page'])
+        for src in found['images']:
+            image_pages[src].append(found['page'])
+        if found['failures']:
+            failing[found['page']] = found['failures']
+
+    color_table = ColorTable.from_config(config)
+    color_report = {}
+    for old_color_hex, count in colors.most_common():
+        try:
+            style, error = color_table.lookup(old_color_hex)[0][1], None
+        except KeyError as e:
+            style, error = None, e.args[0]
+        color_report[old_color_hex] = {'count': count,
+            'pages': color_pages[old_color_hex], 'style': style, 'error': error}
+
+    transcriptions = TranscriptionStore.from_config(config)
+    image_report = {}
+    for src, count in images.most_common():
+        image_report[src] = {'count': count, 'pages': image_pages[src],
+            'missing': not os.path.isfile(image_path(src)),
+            'transcribed': not transcriptions.lookup(src) is None}
+
+    return {
+        'pages': len(findings),
+        'bytes': sum(found['bytes'] for found in findings),
+        'tags': dict(tags.most_common()),
+        'classes': dict(classes.most_common()),
+        'colors': color_report,
+        'images': image_report,
+        'unsupported_tags': dict(unsupported.most_common()),
+        'skipped_tags': dict(skipped.most_common()),
+        'failing_pages': failing
+    }
+
+def summarize(report):
+    '''
+    Returns a short description of the report for the log.
+    '''
+
+    reused = sum(1 for image in report['images'].values() if image['count'] > 1)
+    missing = sum(1 for image in report['images'].values() if image['missing'])
+    unmapped = sum(1 for color in report['colors'].values()
+        if not color['error'] is None)
+    lines = [
+        'Scanned {} pages ({} bytes)'.format(report['pages'], report['bytes']),
+        '{} distinct tags, {} distinct tag classes'.format(len(report['tags']),
+            len(report['classes'])),
+        '{} distinct colors, {} unmapped'.format(len(report['colors']), unmapped),
+        '{} distinct images, {} reused, {} missing'.format(len(report['images']),
+            reused, missing),
+        '{} unclosed unsupported tags skipped'.format(
+            sum(report['skipped_tags'].values())),
+        '{} pages would fail'.format(len(report['failing_pages']))
+    ]
+    for page, failures in sorted(report['failing_pages'].items()):
+        lines.append('  {}:'.format(page))
+        lines.extend('    {}'.format(failure) for failure in failures)
+    return '\n'.join(lines)
+
+def execute():
+    config = htmlscrubber.load_config()
+
+    parser = argparse.ArgumentParser(
+        description='Take stock of the raw pages without scrubbing them')
+
+    parser.add_argument('source', type=str, nargs='?', default=None,
+        help='The pages to scan, as for -batch (the raw folder by default).')
+    parser.add_argument('-report', type=str, default=DEFAULT_REPORT_FILENAME,
+        help='Write the report as json to this file.')
+    parser.add_argument('-workers', type=int, default=None,
+        help='Number of processes (default is the number of cores).')
+    parser.add_argument('-tokenizer', type=str, default=None,
+        choices=tokenizer_names(),
+        help='The tokenizer backend to read the html with (default is the '
+        'tokenizer option of config.ini).')
+
+    args = parser.parse_args()
+    if not args.tokenizer is None:
+        config['DEFAULT']['tokenizer'] = args.tokenizer
+
+    source = resolve_path('raw') if args.source is None else args.source
+    pages = htmlscrubber.collect_pages(source)
+    report = build_report(scan_pages(pages, config, args.workers), config)
+
+    with open(args.report, 'w') as report_file:
+        json.dump(report, report_file, indent=1)
+    logging.info(summarize(report))
+    logging.info('Wrote the report to {}'.format(args.report))
+
+    return 1 if report['failing_pages'] else 0
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+    logging.getLogger().addHandler(logging.StreamHandler())
+    exit(execute())
@@ -0,0 +1,85 @@
+'''
+module manifest
+
+Keeps track of the inputs every output of a page was built from, so that a
+target is only rebuilt when one of its inputs has changed.
+'''
+
+import hashlib
+import json
+
+from htmlparse import own_items
+from problem import ProblemTemplate
+from transcriptions import TranscriptionStore
+
+MANIFEST_FILENAME = '.manifest.json'
+
+# The config sections read when a section contains colored spans
+COLOR_SECTIONS = ['OLD_COLOR_NAMES', 'COLOR_MAPPING', 'NEW_COLOR_HEX_VALUES']
+
+
+class BuildManifest():
+    '''
+    The manifest of a single page, kept as state of the sink its outputs go
+    to (see sinks). For each target, it records the dependencies the section
+    parser reported (colors, images, template) and a fingerprint of the inputs
+    those dependencies refer to, along with the raw file hash and the parser
+    version.
+    '''
+
+    def __init__(self, sink, page):
+        self._sink = sink
+        self._page = page
+        self._targets = sink.read_state(page, MANIFEST_FILENAME) or {}
+
+    def is_current(self, target, digest, parser_class, config, image_mode):
+        entry = self._targets.get(target)
+        if entry is None:
+            return False
+
+        current = fingerprint(digest, parser_class, entry['dependencies'],
+            entry.get('images', []), config, image_mode)
+        return entry['fingerprint'] == current
+
+    def record(self, target, digest, parser, config, image_mode):
+        dependencies = sorted(parser.dependencies)
+        self._targets[target] = {
+            'dependencies': dependencies,
+            'images': parser.images,
+            'fingerprint': fingerprint(digest, type(parser), dependencies,
+                parser.images, config, image_mode)
+        }
+
+    def save(self):
+        self._sink.write_state(self._page, MANIFEST_FILENAME, self._targets)
+
+    def __repr__(self):
+        return 'BuildManifest({}, {})'.format(self._page, self._sink)
+
+
+def fingerprint(digest, parser_class, dependencies, images, config, image_mode):
+    '''
+    Hashes everything the output of a section parser depends on. Only the
+    inputs named by the dependencies are included, so that, for example, a
+    color change does not affect a section without colored spans. The stored
+    transcriptions of the images in the section are included as well.
+    '''
+
+    inputs = {
+        'raw': digest,
+        'parser': [parser_class.__name__, parser_class.version],
+        'dependencies': sorted(dependencies)
+    }
+
+    if 'colors' in dependencies:
+        inputs['colors'] = {section: own_items(config, section)
+            for section in COLOR_SECTIONS}
+    if 'images' in dependencies:
+        transcriptions = TranscriptionStore.from_config(config)
+        inputs['images'] = [config['DEFAULT']['default_image_text'], image_mode,
+            [transcriptions.lookup(src) for src in images]]
+    if 'template' in dependencies:
+        inputs['template'] = ProblemTemplate.from_config(config).digest
+
+    encoded = json.dumps(inputs, sort_keys=True).encode('utf-8')
+    return hashlib.sha256(encoded).hexdigest()
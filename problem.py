@@ -1,17 +1,123 @@
+import hashlib
 import logging
+import os
+import string
+import threading
 
 from htmlparse import CustomHTMLParser
+from storage import resolve_path
+import tracing
+
+DEFAULT_TEMPLATE_FILENAME = 'problem_template.txt'
+
+
+class ProblemTemplate():
+    '''
+    The template each problem is written with. It is read once and split into
+    its literal text and replacement fields up front, so rendering a problem
+    is a single join. Templates are shared by every parser in the process and
+    reloaded when the file changes.
+    '''
+
+    # Templates already loaded in this process, by filename
+    _loaded = {}
+    _loaded_lock = threading.Lock()
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.mtime = os.path.getmtime(filename)
+        with open(filename) as template_file:
+            text = template_file.read()
+
+        self.digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        self._parts = list(string.Formatter().parse(text))
+        self.fields = [field for literal, field, spec, conversion in self._parts
+            if not field is None]
+
+    @classmethod
+    def open(cls, filename):
+        with cls._loaded_lock:
+            template = cls._loaded.get(filename)
+            if template is None or template.mtime != os.path.getmtime(filename):
+                template = cls._loaded[filename] = cls(filename)
+
+        return template
+
+    @classmethod
+    def from_config(cls, config):
+        filename = config['DEFAULT'].get('problem_template',
+            DEFAULT_TEMPLATE_FILENAME)
+        return cls.open(resolve_path(filename))
+
+    def render(self, data):
+        '''
+        Same as str.format(**data) on the template text, as long as the fields
+        are plain names.
+        '''
+        pieces = []
+        for literal, field, spec, conversion in self._parts:
+            pieces.append(literal)
+            if not field is None:
+                value = data[field]
+                if conversion == 'r':
+                    value = repr(value)
+                elif conversion == 's':
+                    value = str(value)
+                elif conversion == 'a':
+                    value = ascii(value)
+                pieces.append(format(value, spec))
+
+        return ''.join(pieces)
+
+    def __repr__(self):
+        return 'ProblemTemplate({})'.format(self.filename)
+
 
 class ProblemParser(CustomHTMLParser):
-    def __init__(self, outputfile, interactive, config):
-        super(ProblemParser, self).__init__(outputfile, interactive, config)
-        self._data = {}
+    '''
+    Converts the lesson problems of the section. Each lessonprob division is
+    rendered through the template and written out as soon as it closes, so a
+    section may hold any number of problems. The text of each field is
+    collected as a list of fragments and joined once the problem is done.
+    '''
+
+    # Version 2 writes each problem once, when its division closes. Version 3
+    # also writes a problem left open when the next one or the section starts.
+    # Version 4 is fed only the markup of its section, see CustomHTMLParser.
+    # Version 5 finds the verdict of an answer in its whole text, which may
+    # come in several chunks
+    version = 5
+
+    # Elements that never have an end tag, so they do not nest
+    VOID_TAGS = {'img', 'br', 'hr', 'input', 'meta', 'link'}
+
+    def __init__(self, outputfile, interactive, config, defer_images=False):
+        super(ProblemParser, self).__init__(outputfile, interactive, config,
+            defer_images)
+        self._fields = None
         self._target = None
         self._level = 0
+        self._template = ProblemTemplate.from_config(config)
+        self.problems = 0
+
+    def in_problem(self):
+        return not self._fields is None
 
     def handle_starttag(self, tag, attrs):
-        if tag == 'span':
+        if not self._tracer is None:
+            self._tracer.record(tracing.START_TAG, self._trace_name, tag,
+                self._level)
+
+        if tag == 'div' and ('class', 'lessonprob') in attrs:
+            self.start_problem()
+            return
+        elif not self.in_problem():
+            return
+
+        if not tag in self.VOID_TAGS:
             self._level += 1
+
+        if tag == 'span':
             if ('class', 'title') in attrs:
                 self._target = 'title'
             elif ('class', 'hint') in attrs:
@@ -22,78 +128,109 @@ class ProblemParser(CustomHTMLParser):
                 except AttributeError:
                     pass
         elif tag == 'div':
-            self._level += 1
-            if ('class', 'lessonprob') in attrs:
-                self._level = 0
-            elif ('class', 'choiceanswer') in attrs:
+            if ('class', 'choiceanswer') in attrs:
                 self._target = self.get_id(attrs)
             elif ('class', 'answer') in attrs:
                 self._target = 'answer' + self.get_id(attrs)[2]
             elif ('class', 'response') in attrs:
                 self._target = 'answer' + self.get_id(attrs)[2]
-
-        elif tag in ['td', 'i', 'strong', 'b', 'tr', 'tbody', 'table']:
-            self._level += 1
         elif tag == 'img':
             content = self.get_image_text(attrs)
             self.handle_data(content)
-        else:
-            pass
-            #logging.warn(tag)
-        #logging.warn('+{} -> {}'.format(tag, self._level))
 
     def handle_data(self, data):
         data = data.replace('\n', '')
 
         if data and not self._target is None:
-            if not self._target in self._data:
-                self._data[self._target] = ''
-
-            # Check if we are doing the response, which would indicate if
-            # we are correct or not. This requires its own formatting
-            if self._target.startswith('answer'):
-                target = 'is{}correct'.format(self._target[-1])
-                if 'This answer is incorrect' in data:
-                    self._data[target] = False
-                    data = data[25:]
-                elif 'This answer is correct' in data:
-                    logging.debug('Correct [{}]: {}'.format(self._target, data))
-                    self._data[target] = True
-                    data = data[25:]
-                elif not target in self._data:
-                    self._data[target] = False
-
-            logging.debug('{} -> {}'.format(self._target, data))
-            self._data[self._target] += data
+            if not self._tracer is None:
+                self._tracer.record(tracing.FIELD, self._trace_name,
+                    self._target, tracing.preview(data))
+
+            fragments = self._fields.get(self._target)
+            if fragments is None:
+                fragments = self._fields[self._target] = []
+            fragments.append(data)
 
     def handle_endtag(self, tag):
+        if not self._tracer is None:
+            self._tracer.record(tracing.END_TAG, self._trace_name, tag,
+                self._level)
+
+        if not self.in_problem() or tag in self.VOID_TAGS:
+            return
+
         self._level -= 1
-        #logging.info('-{} -> {}'.format(tag, self._level))
         if self._level < 0:
             self.finalize()
 
+    def end_section(self):
+        if self.in_problem():
+            logging.warning('Problem {} is still open at the end of the '
+                'section'.format(self.problems + 1))
+            self.finalize()
+
+    def start_problem(self):
+        if self.in_problem():
+            logging.warning('Problem {} is still open when the next one '
+                'starts'.format(self.problems + 1))
+            self.finalize()
+
+        self._fields = {}
+        self._target = None
+        self._level = 0
+
     def finalize(self):
-        logging.debug('Finalized Data: {}'.format(self._data))
-        logging.debug('Recovered Data Keys: {}'.format(self._data.keys()))
+        '''
+        Renders the finished problem to the output and waits for the next one.
+        '''
+        data = {target: ''.join(fragments)
+            for target, fragments in self._fields.items()}
+        if not self._tracer is None:
+            self._tracer.record(tracing.FINALIZE, self._trace_name, sorted(data))
         
         # For each item, we must wrap the correct solution/answer in an
-        # appropriately formatted div.
+        # appropriately formatted div. The response, which tells if the
+        # answer is correct or not, is part of its text.
         
         for i in range(1,4): #1,2,3
-            if self._data['is{}correct'.format(i)]:
+            attr_str = 'answer{}'.format(i)
+            correct, data[attr_str] = self.take_verdict(data.get(attr_str, ''))
+            if correct:
                 format_string = '<div><a id="solutionlink">Solution</a></div>'
                 format_string +='\n\n<div class="solution" id="solution">{}</div>'
-                self._data['response{}'.format(i)] = 'Correct'
+                data['response{}'.format(i)] = 'Correct'
             else:
                 format_string = '<div class="answer" id="choiceanswer{}">{{}}</div>'.format(i)
-                self._data['response{}'.format(i)] = 'Incorrect'
-            attr_str = 'answer{}'.format(i)
-            self._data[attr_str] = format_string.format(self._data[attr_str])
+                data['response{}'.format(i)] = 'Incorrect'
+            data[attr_str] = format_string.format(data[attr_str])
+
+        missing = [field for field in self._template.fields if not field in data]
+        if missing:
+            logging.warning('Problem {} is missing {}'.format(self.problems + 1,
+                ', '.join(missing)))
+            for field in missing:
+                data[field] = ''
 
         # Write it to the template
-        with open('problem_template.txt') as template_file:
-            template = template_file.read()
-            self._handler.write(template.format(**self._data))
+        self.dependencies.add('template')
+        self._handler.write(self._template.render(data))
+
+        self.problems += 1
+        if not self._stats is None:
+            self._stats.count('problems')
+        self._fields = self._target = None
+
+    def take_verdict(self, text):
+        '''
+        Returns whether the text of an answer says it is correct, and the text
+        without the verdict.
+        '''
+        for verdict, correct in (('This answer is incorrect', False),
+                ('This answer is correct', True)):
+            found = text.find(verdict)
+            if found != -1:
+                return correct, text[:found] + text[found + 25:]
+        return False, text
 
     def get_id(self, attrs):
         for attr, value in attrs:
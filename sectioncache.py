@@ -0,0 +1,184 @@
+'''
+module sectioncache
+
+Many lessons share sections byte for byte (the same discussion boilerplate,
+the same problem blocks), so a converted section is kept in memory and reused
+for any other section with the same raw bytes. The key hashes the raw bytes,
+the parser class and its version, the whole config, how images are handled,
+and the tokenizer backend the section was read with. Since a section may also depend on the template and the stored
+transcriptions, which are not part of the key, a stored section also carries
+the fingerprint of those and is only reused while that fingerprint still
+holds. The cache is bounded by the size of the outputs it
+keeps, evicting the least recently used sections first.
+
+Every process has its own cache, shared by all its threads, so the workers of
+a batch each reuse what they converted themselves.
+'''
+
+import collections
+import hashlib
+import json
+import threading
+
+from problem import ProblemTemplate
+from transcriptions import TranscriptionStore
+
+# Megabytes of converted sections kept by default, see shared_cache
+DEFAULT_CACHE_SIZE = 64
+
+# The cache of the process, and the size it was created with
+_shared = None
+_shared_size = None
+_shared_lock = threading.Lock()
+
+
+class CachedSection():
+    '''
+    What converting a section produced: its output, and what the section
+    parser recorded for the build manifest and the image queue.
+    '''
+
+    __slots__ = ['output', 'dependencies', 'images', 'deferred_images',
+        'fingerprint']
+
+    def __init__(self, output, parser, fingerprint):
+        self.output = output
+        self.dependencies = frozenset(parser.dependencies)
+        self.images = tuple(parser.images)
+        self.deferred_images = tuple(parser.deferred_images)
+        self.fingerprint = fingerprint
+
+    def restore(self, parser, writer):
+        '''
+        Writes the output and gives the (unused) section parser the state it
+        would have had after converting the section itself.
+        '''
+        writer.write(self.output)
+        parser.dependencies = set(self.dependencies)
+        parser.images = list(self.images)
+        parser.deferred_images = list(self.deferred_images)
+
+    def __repr__(self):
+        return 'CachedSection({} characters)'.format(len(self.output))
+
+
+class SectionCache():
+    '''
+    A least recently used cache of converted sections, holding at most
+    max_size characters of output.
+    '''
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._sections = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def lookup(self, key, config):
+        '''
+        Returns the section stored under the key, or None if there is none or
+        its inputs changed since.
+        '''
+        with self._lock:
+            section = self._sections.get(key)
+            if not section is None:
+                self._sections.move_to_end(key)
+
+        if not section is None and section.fingerprint != outside_inputs(
+                section.dependencies, section.images, config):
+            section = None
+
+        with self._lock:
+            if section is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return section
+
+    def store(self, key, parser, output, config):
+        '''
+        Keeps the output of the section parser, evicting the least recently
+        used sections to make room.
+        '''
+        if len(output) > self.max_size:
+            return
+
+        section = CachedSection(output, parser, outside_inputs(
+            parser.dependencies, parser.images, config))
+        with self._lock:
+            replaced = self._sections.pop(key, None)
+            if not replaced is None:
+                self.size -= len(replaced.output)
+            self._sections[key] = section
+            self.size += len(output)
+
+            while self.size > self.max_size:
+                evicted_key, evicted = self._sections.popitem(last=False)
+                self.size -= len(evicted.output)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._sections.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._sections)
+
+    def __repr__(self):
+        return 'SectionCache({} sections, {} of {} characters)'.format(
+            len(self._sections), self.size, self.max_size)
+
+
+def shared_cache(config):
+    '''
+    Returns the cache of the process, sized by the section_cache_size option
+    (in megabytes) of the config, or None if the size is 0.
+    '''
+    global _shared, _shared_size
+    size = config['DEFAULT'].getfloat('section_cache_size', DEFAULT_CACHE_SIZE)
+    if size <= 0:
+        return None
+
+    with _shared_lock:
+        if _shared is None or _shared_size != size:
+            _shared = SectionCache(int(size * 1e6))
+            _shared_size = size
+    return _shared
+
+def config_digest(config):
+    '''
+    Hashes every option of the config. The raw values are hashed, since
+    interpolating them all would cost more than converting a small section.
+    '''
+    options = [sorted(config.defaults().items())]
+    for section in config.sections():
+        options.append([section, sorted(config.items(section, raw=True))])
+    return hashlib.sha256(json.dumps(options).encode('utf-8')).hexdigest()
+
+def outside_inputs(dependencies, images, config):
+    '''
+    Returns what a section depends on besides its raw bytes and the config:
+    the template, and the stored transcriptions of its images.
+    '''
+    inputs = []
+    if 'template' in dependencies:
+        inputs.append(ProblemTemplate.from_config(config).digest)
+    if 'images' in dependencies:
+        transcriptions = TranscriptionStore.from_config(config)
+        inputs.append([transcriptions.lookup(src) for src in images])
+    return inputs
+
+def section_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+def section_key(digest, parser_class, config_hash, image_mode, tokenizer):
+    '''
+    Returns the key of a section with the given raw bytes digest. The backends
+    are meant to agree, but the key still tells them apart, so that comparing
+    them (see htmlscrubber.compare_tokenizers) converts with each of them.
+    '''
+    key = '{}\0{}\0{}\0{}\0{}\0{}'.format(digest, parser_class.__name__,
+        parser_class.version, config_hash, image_mode, tokenizer)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
@@ -0,0 +1,331 @@
+#!/usr/bin/python3
+'''
+module server
+
+Serves the scrubber over HTTP on the local machine, using only the standard
+library, so other tools can convert pages without the raw and output folders.
+The pages are scrubbed by a pool of worker processes started (and warmed up,
+with the config, color table, and template loaded) before the first request.
+
+    POST /scrub      the raw html of a page as the body. Answers with
+                     {"sections": {target: html}}. Add ?targets=discussion,...
+                     to convert only some sections.
+    POST /batch      {"pages": {name: html}, "targets": [...]} as json. The
+                     pages are scrubbed in parallel, and the answer holds
+                     {"sections": ...} or {"error": ...} for each name.
+    GET  /health     whether the server is up, and its workers.
+    GET  /metrics    request and page counts, latencies, and throughput.
+
+At most limit pages are accepted at a time; beyond that, requests are turned
+away with 503 so a client can back off instead of piling up work.
+'''
+
+import argparse
+import collections
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import os
+import threading
+import time
+import traceback
+from urllib.parse import parse_qs, urlsplit
+
+import htmlscrubber
+from tokenizers import tokenizer_names
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8080
+
+# Latencies kept for the percentiles of the metrics
+LATENCY_WINDOW = 1000
+
+# The scrubber of a worker process, see start_worker
+_scrubber = None
+
+
+class Admission():
+    '''
+    Counts the pages being scrubbed, and turns away requests that would bring
+    them above the limit.
+    '''
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.pending = 0
+        self._lock = threading.Lock()
+
+    def enter(self, pages):
+        '''
+        Admits the pages if there is room for them. Returns whether it did.
+        '''
+        with self._lock:
+            if self.pending + pages > self.limit:
+                return False
+            self.pending += pages
+            return True
+
+    def leave(self, pages):
+        with self._lock:
+            self.pending -= pages
+
+    def __repr__(self):
+        return 'Admission({} of {})'.format(self.pending, self.limit)
+
+
+class Metrics():
+    '''
+    Counts the requests and pages served, and keeps the latency of the recent
+    requests. Shared by the threads handling the requests.
+    '''
+
+    def __init__(self):
+        self.started = time.time()
+        self.counts = collections.Counter()
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self._lock = threading.Lock()
+
+    def record(self, seconds, pages, errors):
+        with self._lock:
+            self.counts['requests'] += 1
+            self.counts['pages'] += pages
+            self.counts['errors'] += errors
+            self.latencies.append(seconds)
+
+    def count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def as_dict(self):
+        with self._lock:
+            counts = dict(self.counts)
+            latencies = sorted(self.latencies)
+
+        uptime = time.time() - self.started
+        result = {
+            'uptime': uptime,
+            'requests': counts.get('requests', 0),
+            'pages': counts.get('pages', 0),
+            'errors': counts.get('errors', 0),
+            'rejected': counts.get('rejected', 0),
+            'pages_per_sec': counts.get('pages', 0) / uptime if uptime else 0.0,
+            'latency': None
+        }
+        if latencies:
+            result['latency'] = {
+                'mean': sum(latencies) / len(latencies),
+                'p50': percentile(latencies, 0.5),
+                'p95': percentile(latencies, 0.95),
+                'p99': percentile(latencies, 0.99),
+                'max': latencies[-1]
+            }
+        return result
+
+    def __repr__(self):
+        return 'Metrics({} requests)'.format(self.counts['requests'])
+
+
+class ScrubServer(ThreadingHTTPServer):
+    '''
+    The HTTP server, holding the worker pool and what the requests share.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, address, executor, workers, limit):
+        super(ScrubServer, self).__init__(address, ScrubHandler)
+        self.executor = executor
+        self.workers = workers
+        self.admission = Admission(limit)
+        self.metrics = Metrics()
+
+
+class ScrubHandler(BaseHTTPRequestHandler):
+    '''
+    Handles a single request to the server.
+    '''
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path == '/health':
+            self.send_json(200, {'status': 'ok', 'workers': self.server.workers,
+                'pending': self.server.admission.pending})
+        elif path == '/metrics':
+            metrics = self.server.metrics.as_dict()
+            metrics['pending'] = self.server.admission.pending
+            metrics['limit'] = self.server.admission.limit
+            self.send_json(200, metrics)
+        else:
+            self.send_json(404, {'error': 'Unknown path {}'.format(path)})
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if not url.path in ('/scrub', '/batch'):
+            self.send_json(404, {'error': 'Unknown path {}'.format(url.path)})
+            return
+
+        try:
+            body = self.read_body()
+            if url.path == '/scrub':
+                targets = parse_qs(url.query).get('targets')
+                if not targets is None:
+                    targets = ','.join(targets).split(',')
+                pages = {None: body}
+            else:
+                request = json.loads(body.decode('utf-8'))
+                if not isinstance(request, dict):
+                    raise ValueError('the body must be a json object')
+                pages = request['pages']
+                targets = request.get('targets')
+                if not isinstance(pages, dict):
+                    raise ValueError('"pages" must map names to html')
+            check_targets(targets)
+        except (KeyError, ValueError) as e:
+            self.send_json(400, {'error': 'Bad request: {}'.format(e)})
+            return
+
+        if len(pages) > self.server.admission.limit:
+            self.send_json(413, {'error': 'A batch holds at most {} pages'.format(
+                self.server.admission.limit)})
+            return
+        if not self.server.admission.enter(len(pages)):
+            self.server.metrics.count('rejected')
+            self.send_json(503, {'error': 'Too many pages in progress'},
+                {'Retry-After': '1'})
+            return
+
+        start = time.perf_counter()
+        try:
+            results = self.scrub_pages(pages, targets)
+        finally:
+            self.server.admission.leave(len(pages))
+        errors = sum(1 for result in results.values() if 'error' in result)
+        self.server.metrics.record(time.perf_counter() - start, len(pages),
+            errors)
+
+        if url.path == '/scrub':
+            result = results[None]
+            self.send_json(422 if 'error' in result else 200, result)
+        else:
+            self.send_json(200, {'pages': results})
+
+    def read_body(self):
+        length = self.headers.get('Content-Length')
+        if length is None:
+            raise ValueError('Content-Length is required')
+        return self.rfile.read(int(length))
+
+    def scrub_pages(self, pages, targets):
+        '''
+        Scrubs the pages (name -> html) in the workers at once. Returns the
+        result of each name.
+        '''
+        futures = {name: self.server.executor.submit(scrub_in_worker, html,
+            targets) for name, html in pages.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+    def send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug('{} {}'.format(self.address_string(), format % args))
+
+
+def start_worker(config_filename, tokenizer):
+    '''
+    Runs in each worker process as it starts, loading the config, color table,
+    and template once for all the pages it will scrub.
+    '''
+    global _scrubber
+    # The progress of every page would drown out the log of the server
+    logging.getLogger().setLevel(logging.WARNING)
+    _scrubber = htmlscrubber.Scrubber(config_filename)
+    if not tokenizer is None:
+        _scrubber.config['DEFAULT']['tokenizer'] = tokenizer
+
+def warm_worker(i):
+    return os.getpid()
+
+def scrub_in_worker(html, targets):
+    '''
+    Scrubs the page with the scrubber of the worker. Returns {"sections": ...},
+    or {"error": ...} with the traceback if it failed.
+    '''
+    try:
+        return {'sections': _scrubber.scrub(html, targets)}
+    except Exception:
+        return {'error': traceback.format_exc()}
+
+def check_targets(targets):
+    if targets is None:
+        return
+    if not isinstance(targets, list):
+        raise ValueError('the targets must be a list')
+    for target in targets:
+        if not target in htmlscrubber.TARGETS:
+            raise ValueError('unknown target "{}", expected one of {}'.format(
+                target, ', '.join(htmlscrubber.TARGETS)))
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def start_pool(workers, config_filename=htmlscrubber.CONFIG_FILENAME,
+        tokenizer=None):
+    '''
+    Starts the worker processes and waits until every one of them is ready.
+    '''
+    workers = workers or os.cpu_count() or 1
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=start_worker,
+        initargs=(config_filename, tokenizer))
+    # Submitted together, every task gets a process of its own
+    pids = set(executor.map(warm_worker, range(workers)))
+    logging.info('Started {} workers'.format(len(pids)))
+    return executor, workers
+
+def execute():
+    parser = argparse.ArgumentParser(
+        description='Serve the scrubber over HTTP on this machine')
+
+    parser.add_argument('-host', type=str, default=DEFAULT_HOST,
+        help='The address to listen on (default is localhost only).')
+    parser.add_argument('-port', type=int, default=DEFAULT_PORT,
+        help='The port to listen on.')
+    parser.add_argument('-workers', type=int, default=None,
+        help='Number of worker processes (default is the number of cores).')
+    parser.add_argument('-limit', type=int, default=None,
+        help='Most pages scrubbed or waiting at a time (default is four per '
+        'worker). Requests beyond it are answered with 503.')
+    parser.add_argument('-tokenizer', type=str, default=None,
+        choices=tokenizer_names(),
+        help='The tokenizer backend to read the html with (default is the '
+        'tokenizer option of config.ini).')
+
+    args = parser.parse_args()
+
+    executor, workers = start_pool(args.workers, tokenizer=args.tokenizer)
+    limit = 4 * workers if args.limit is None else args.limit
+    server = ScrubServer((args.host, args.port), executor, workers, limit)
+    logging.info('Serving on http://{}:{} with at most {} pages at a time'.format(
+        args.host, server.server_address[1], limit))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info('Stopped serving')
+    finally:
+        server.server_close()
+        executor.shutdown()
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+    logging.getLogger().addHandler(logging.StreamHandler())
+    execute()
@@ -0,0 +1,508 @@
+'''
+module sinks
+
+Where the converted sections end up. By default every page gets a folder in
+output with a file per section, but a large batch can instead go into a single
+archive (zip or tar) or SQLite database, which are written in batches. Every
+sink skips sections whose content did not change since they were last
+written, so unchanged outputs are left alone (and keep their modification
+times). For serving, the output folder can also get a copy of each section
+named after its content, compressed ahead of time.
+
+A sink also keeps what is remembered about each page between runs (the build
+manifest and the section positions) as named json documents, so an archive or
+database leaves nothing behind in the output folder.
+
+A sink has prepare(page), called before a page is scrubbed, exists(page,
+target), write(page, target, text) returning whether anything was written
+(None if not known yet), read_state(page, name) returning the document or
+None, write_state(page, name, data), commit(), and close().
+'''
+
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import sqlite3
+import tarfile
+import tempfile
+import time
+import zipfile
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from storage import read_json, resolve_path, write_json
+
+# Sections written before a bulk sink commits them
+DEFAULT_BATCH_SIZE = 500
+
+ARCHIVE_EXTENSIONS = ['.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz']
+SQLITE_EXTENSIONS = ['.sqlite', '.sqlite3', '.db']
+
+# Maps each section of a page to its content named and compressed files
+ASSETS_FILENAME = 'assets.json'
+
+# Hex digits of the content hash put in the file names
+ASSET_HASH_LENGTH = 16
+
+# Added to the name of an archive for the file holding the state of its pages
+STATE_SUFFIX = '.state.json'
+
+
+class DirectorySink():
+    '''
+    Writes each section to output/<page>/<target>.html, unless the file
+    already holds the same content. When a section changes, the content named
+    files of its previous content (see PrecompressedSink) are removed along
+    with their entry in assets.json, which would otherwise point at the old
+    content.
+    '''
+
+    def prepare(self, page):
+        dirpath = resolve_path('output', page)
+        if not os.path.exists(dirpath):
+            logging.info('Creating directory {}'.format(dirpath))
+            os.mkdir(dirpath)
+        else:
+            logging.warn('Directory already exists. Will overwrite files')
+
+    def path(self, page, target):
+        return resolve_path('output', page, target) + '.html'
+
+    def exists(self, page, target):
+        return os.path.exists(self.path(page, target))
+
+    def write(self, page, target, text):
+        filename = self.path(page, target)
+        if read_text(filename) == text:
+            return False
+
+        with open(filename, 'w') as outfile:
+            outfile.write(text)
+        self.drop_assets(page, target)
+        return True
+
+    def assets_path(self, page):
+        return resolve_path('output', page, ASSETS_FILENAME)
+
+    def read_assets(self, page):
+        return read_json(self.assets_path(page)) or {}
+
+    def drop_assets(self, page, target):
+        assets = self.read_assets(page)
+        entry = assets.pop(target, None)
+        if entry is None:
+            return
+
+        for name in asset_names(entry):
+            filename = resolve_path('output', page, name)
+            if os.path.exists(filename):
+                os.remove(filename)
+        self.save_assets(page, assets)
+
+    def save_assets(self, page, assets):
+        write_json(self.assets_path(page), assets)
+
+    def read_state(self, page, name):
+        return read_json(resolve_path('output', page, name))
+
+    def write_state(self, page, name, data):
+        write_json(resolve_path('output', page, name), data)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __repr__(self):
+        return 'DirectorySink({})'.format(resolve_path('output'))
+
+
+class PrecompressedSink(DirectorySink):
+    '''
+    Writes each section to output/<page>/<target>.html like DirectorySink,
+    and also to <target>.<hash>.html, named after its content so it can be
+    served with immutable cache headers, along with a gzip (.gz) and, if the
+    brotli package is installed, a brotli (.br) compressed copy. The
+    assets.json of the page maps each target to its current files; the files
+    of the content it replaces are removed.
+    '''
+
+    def exists(self, page, target):
+        if not super(PrecompressedSink, self).exists(page, target):
+            return False
+        entry = self.read_assets(page).get(target)
+        return not entry is None and self.asset_files_exist(page, entry)
+
+    def asset_files_exist(self, page, entry):
+        return all(os.path.exists(resolve_path('output', page, name))
+            for name in asset_names(entry))
+
+    def write(self, page, target, text):
+        # Drops the entry of the previous content if the section changed
+        written = super(PrecompressedSink, self).write(page, target, text)
+
+        data = text.encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        assets = self.read_assets(page)
+        entry = assets.get(target)
+        if not entry is None and entry['hash'] == digest and \
+                self.asset_files_exist(page, entry):
+            return written
+
+        assets[target] = self.write_assets(page, target, data, digest)
+        if not entry is None:
+            self.remove_assets(page, entry, assets[target])
+        self.save_assets(page, assets)
+        return True
+
+    def write_assets(self, page, target, data, digest):
+        '''
+        Writes the content named and compressed files of the section. Returns
+        their entry for assets.json.
+        '''
+        name = '{}.{}.html'.format(target, digest[:ASSET_HASH_LENGTH])
+        # No time stamp, so the same content always compresses the same
+        encoded = {'gzip': (name + '.gz', gzip.compress(data, 9, mtime=0))}
+        if not brotli is None:
+            encoded['br'] = (name + '.br', brotli.compress(data))
+
+        for filename, content in [(name, data)] + list(encoded.values()):
+            with open(resolve_path('output', page, filename), 'wb') as asset_file:
+                asset_file.write(content)
+
+        return {
+            'file': name,
+            'hash': digest,
+            'size': len(data),
+            'encodings': {encoding: filename
+                for encoding, (filename, content) in encoded.items()}
+        }
+
+    def remove_assets(self, page, old_entry, new_entry):
+        kept = set(asset_names(new_entry))
+        for name in asset_names(old_entry):
+            filename = resolve_path('output', page, name)
+            if not name in kept and os.path.exists(filename):
+                os.remove(filename)
+
+    def __repr__(self):
+        return 'PrecompressedSink({}, {})'.format(resolve_path('output'),
+            'gzip' if brotli is None else 'gzip and brotli')
+
+
+class MemorySink():
+    '''
+    Keeps the sections and state written for a page, so a worker process can
+    hand them to the sink of the main process. The targets already in that
+    sink, and the state it holds for the page, are given up front.
+    '''
+
+    def __init__(self, existing=(), stored=None):
+        self.existing = set(existing)
+        self.stored = dict(stored or {})
+        self.outputs = []
+        self.state = []
+
+    def prepare(self, page):
+        pass
+
+    def exists(self, page, target):
+        return target in self.existing
+
+    def write(self, page, target, text):
+        # Whether it changes anything is up to the sink it is handed to
+        self.outputs.append((target, text))
+        return None
+
+    def read_state(self, page, name):
+        return self.stored.get(name)
+
+    def write_state(self, page, name, data):
+        self.stored[name] = data
+        self.state.append((name, data))
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __repr__(self):
+        return 'MemorySink({} outputs)'.format(len(self.outputs))
+
+
+class ArchiveSink():
+    '''
+    Writes the sections as <page>/<target>.html entries of a zip or tar
+    archive, encoded as utf-8. The written sections are kept until the batch
+    is full, then added to the archive at once. New entries are appended when
+    the format allows it; replacing entries (or adding to a compressed tar)
+    rewrites the archive. The state of the pages is kept in a single json file
+    named after the archive, written on commit.
+    '''
+
+    def __init__(self, filename, batch_size=DEFAULT_BATCH_SIZE):
+        self.filename = filename
+        self.batch_size = batch_size
+        self._zip = filename.endswith('.zip')
+        self._appendable = self._zip or filename.endswith('.tar')
+        self._pending = {}
+
+        # Entry name -> (size, crc) of the content already in the archive
+        self._index = {}
+        if os.path.exists(filename):
+            self._index = self.read_index()
+
+        # Page -> name -> document
+        self._state_filename = filename + STATE_SUFFIX
+        self._state = read_json(self._state_filename) or {}
+        self._state_changed = False
+
+    def prepare(self, page):
+        pass
+
+    def entry_name(self, page, target):
+        return '{}/{}.html'.format(page, target)
+
+    def read_index(self):
+        index = {}
+        if self._zip:
+            with zipfile.ZipFile(self.filename) as archive:
+                for info in archive.infolist():
+                    index[info.filename] = (info.file_size, info.CRC)
+        else:
+            with tarfile.open(self.filename) as archive:
+                for member in archive:
+                    if member.isfile():
+                        data = archive.extractfile(member).read()
+                        index[member.name] = (len(data), zlib_crc(data))
+        return index
+
+    def exists(self, page, target):
+        name = self.entry_name(page, target)
+        return name in self._index or name in self._pending
+
+    def write(self, page, target, text):
+        name = self.entry_name(page, target)
+        data = text.encode('utf-8')
+        if not name in self._pending and \
+                self._index.get(name) == (len(data), zlib_crc(data)):
+            return False
+
+        self._pending[name] = data
+        if len(self._pending) >= self.batch_size:
+            self.commit()
+        return True
+
+    def read_state(self, page, name):
+        return self._state.get(page, {}).get(name)
+
+    def write_state(self, page, name, data):
+        self._state.setdefault(page, {})[name] = data
+        self._state_changed = True
+
+    def commit(self):
+        if self._pending:
+            replacing = any(name in self._index for name in self._pending)
+            if self._appendable and not replacing:
+                self.append(self._pending)
+            else:
+                self.rewrite(self._pending)
+
+            for name, data in self._pending.items():
+                self._index[name] = (len(data), zlib_crc(data))
+            logging.info('Committed {} sections to {}'.format(
+                len(self._pending), self.filename))
+            self._pending = {}
+
+        if self._state_changed:
+            write_json(self._state_filename, self._state, indent=None)
+            self._state_changed = False
+
+    def append(self, entries):
+        if self._zip:
+            with zipfile.ZipFile(self.filename, 'a', zipfile.ZIP_DEFLATED) as archive:
+                for name, data in sorted(entries.items()):
+                    archive.writestr(zip_info(name), data)
+        else:
+            with tarfile.open(self.filename, 'a') as archive:
+                for name, data in sorted(entries.items()):
+                    archive.addfile(tar_info(name, data), io.BytesIO(data))
+
+    def rewrite(self, entries):
+        '''
+        Writes a new archive with the kept entries of the old one followed by
+        the given entries, then puts it in place of the old one.
+        '''
+        dirname = os.path.dirname(os.path.abspath(self.filename))
+        handle, tmpname = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+        os.close(handle)
+        try:
+            if self._zip:
+                with zipfile.ZipFile(tmpname, 'w', zipfile.ZIP_DEFLATED) as new:
+                    if os.path.exists(self.filename):
+                        with zipfile.ZipFile(self.filename) as old:
+                            for info in old.infolist():
+                                if not info.filename in entries:
+                                    new.writestr(info, old.read(info))
+                    for name, data in sorted(entries.items()):
+                        new.writestr(zip_info(name), data)
+            else:
+                with tarfile.open(tmpname, 'w' + tar_compression(self.filename)) as new:
+                    if os.path.exists(self.filename):
+                        with tarfile.open(self.filename) as old:
+                            for member in old:
+                                if not member.name in entries:
+                                    new.addfile(member, old.extractfile(member))
+                    for name, data in sorted(entries.items()):
+                        new.addfile(tar_info(name, data), io.BytesIO(data))
+            os.replace(tmpname, self.filename)
+        finally:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+
+    def close(self):
+        self.commit()
+
+    def __repr__(self):
+        return 'ArchiveSink({})'.format(self.filename)
+
+
+class SQLiteSink():
+    '''
+    Writes the sections to the sections table of an SQLite database, one row
+    per (page, section) along with the sha256 of the content and the time it
+    was written. The rows are committed once the batch is full. The state of
+    the pages goes into the state table, a row per (page, name).
+    '''
+
+    def __init__(self, filename, batch_size=DEFAULT_BATCH_SIZE):
+        self.filename = filename
+        self.batch_size = batch_size
+        self._pending = 0
+        self._connection = sqlite3.connect(filename)
+        self._connection.execute('CREATE TABLE IF NOT EXISTS sections ('
+            'page TEXT NOT NULL, section TEXT NOT NULL, content TEXT NOT NULL, '
+            'hash TEXT NOT NULL, updated REAL NOT NULL, '
+            'PRIMARY KEY (page, section))')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS state ('
+            'page TEXT NOT NULL, name TEXT NOT NULL, content TEXT NOT NULL, '
+            'PRIMARY KEY (page, name))')
+        self._connection.commit()
+
+    def prepare(self, page):
+        pass
+
+    def exists(self, page, target):
+        return not self.stored_hash(page, target) is None
+
+    def stored_hash(self, page, target):
+        row = self._connection.execute(
+            'SELECT hash FROM sections WHERE page = ? AND section = ?',
+            (page, target)).fetchone()
+        return None if row is None else row[0]
+
+    def write(self, page, target, text):
+        digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        if self.stored_hash(page, target) == digest:
+            return False
+
+        self._connection.execute('INSERT OR REPLACE INTO sections '
+            '(page, section, content, hash, updated) VALUES (?, ?, ?, ?, ?)',
+            (page, target, text, digest, time.time()))
+        self._pending += 1
+        if self._pending >= self.batch_size:
+            self.commit()
+        return True
+
+    def read_state(self, page, name):
+        row = self._connection.execute(
+            'SELECT content FROM state WHERE page = ? AND name = ?',
+            (page, name)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def write_state(self, page, name, data):
+        self._connection.execute('INSERT OR REPLACE INTO state '
+            '(page, name, content) VALUES (?, ?, ?)',
+            (page, name, json.dumps(data, sort_keys=True)))
+
+    def commit(self):
+        if self._pending:
+            logging.info('Committed {} sections to {}'.format(self._pending,
+                self.filename))
+        self._connection.commit()
+        self._pending = 0
+
+    def close(self):
+        self.commit()
+        self._connection.close()
+
+    def __repr__(self):
+        return 'SQLiteSink({})'.format(self.filename)
+
+
+def open_sink(spec=None, batch_size=DEFAULT_BATCH_SIZE, precompress=False):
+    '''
+    Returns the sink for the output given on the command line: the output
+    folder (with the content named, compressed copies if precompress is set)
+    if None, else an archive or database chosen by the extension of the file
+    name (resolved against the program folder).
+    '''
+    if spec is None:
+        return PrecompressedSink() if precompress else DirectorySink()
+
+    filename = resolve_path(spec)
+    if any(filename.endswith(extension) for extension in ARCHIVE_EXTENSIONS):
+        return ArchiveSink(filename, batch_size)
+    elif any(filename.endswith(extension) for extension in SQLITE_EXTENSIONS):
+        return SQLiteSink(filename, batch_size)
+
+    raise ValueError('Unknown output "{}", expected a file ending in {}'.format(
+        spec, ', '.join(ARCHIVE_EXTENSIONS + SQLITE_EXTENSIONS)))
+
+def read_text(filename):
+    '''
+    Returns the contents of the text file, or None if it cannot be read.
+    '''
+    try:
+        with open(filename) as infile:
+            return infile.read()
+    except (OSError, ValueError):
+        return None
+
+def asset_names(entry):
+    '''
+    Returns the names of the files listed by an assets.json entry.
+    '''
+    return [entry['file']] + list(entry['encodings'].values())
+
+def zlib_crc(data):
+    return zlib.crc32(data) & 0xffffffff
+
+def zip_info(name):
+    info = zipfile.ZipInfo(name, time.localtime()[:6])
+    info.compress_type = zipfile.ZIP_DEFLATED
+    return info
+
+def tar_info(name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = time.time()
+    return info
+
+def tar_compression(filename):
+    if filename.endswith('.tar.gz') or filename.endswith('.tgz'):
+        return ':gz'
+    elif filename.endswith('.tar.bz2'):
+        return ':bz2'
+    elif filename.endswith('.tar.xz'):
+        return ':xz'
+    return ''
@@ -0,0 +1,115 @@
+'''
+module stats
+
+Optional instrumentation of the scrubber: wall time per stage and counters of
+what was processed. Nothing is measured unless a collection is active, and the
+per tag measurements are only hooked into parsers created while it is, so the
+cost when disabled is a check per page and per parser.
+'''
+
+from collections import Counter, defaultdict
+import contextlib
+import json
+import threading
+import time
+
+# The stats being collected, if any
+_current = None
+_current_lock = threading.Lock()
+
+
+class Stats():
+    '''
+    Accumulates the time spent in each stage (in seconds) and the counters.
+    Stages may be nested: dispatch includes colors and images, and parse
+    includes dispatch, so parse minus dispatch is the time spent tokenizing.
+    '''
+
+    def __init__(self):
+        self.times = defaultdict(float)
+        self.counts = Counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] += time.perf_counter() - start
+
+    def count(self, name, amount=1):
+        self.counts[name] += amount
+
+    def merge(self, stats_dict):
+        '''
+        Adds the results of another collection (as from as_dict), such as the
+        one of a worker process.
+        '''
+        for name, seconds in stats_dict['times'].items():
+            self.times[name] += seconds
+        self.counts.update(stats_dict['counts'])
+
+    def as_dict(self):
+        times = dict(self.times)
+        if 'parse' in times:
+            times['tokenize'] = times['parse'] - times.get('dispatch', 0.0)
+        return {'times': times, 'counts': dict(self.counts)}
+
+    def format_table(self):
+        results = self.as_dict()
+        lines = ['{:<32} {:>12}'.format('stage', 'seconds')]
+        for name, seconds in sorted(results['times'].items()):
+            lines.append('{:<32} {:>12.4f}'.format(name, seconds))
+        lines.append('{:<32} {:>12}'.format('counter', 'count'))
+        for name, amount in sorted(results['counts'].items()):
+            lines.append('{:<32} {:>12}'.format(name, amount))
+        return '\n'.join(lines)
+
+    def write_json(self, filename):
+        with open(filename, 'w') as stats_file:
+            json.dump(self.as_dict(), stats_file, indent=1, sort_keys=True)
+
+    def __repr__(self):
+        return 'Stats({} stages, {} counters)'.format(len(self.times), len(self.counts))
+
+
+def current():
+    '''
+    Returns the stats being collected, or None.
+    '''
+    return _current
+
+@contextlib.contextmanager
+def collect(stats=None):
+    '''
+    Collects stats for everything scrubbed within the block:
+
+        with stats.collect() as collected:
+            scrubber.scrub(html)
+        collected.as_dict()
+    '''
+    global _current
+    if stats is None:
+        stats = Stats()
+
+    with _current_lock:
+        previous, _current = _current, stats
+    try:
+        yield stats
+    finally:
+        with _current_lock:
+            _current = previous
+
+def stage(name):
+    '''
+    Times the block as the named stage if stats are being collected.
+    '''
+    stats = _current
+    if stats is None:
+        return contextlib.nullcontext()
+    return stats.stage(name)
+
+def count(name, amount=1):
+    stats = _current
+    if not stats is None:
+        stats.counts[name] += amount
@@ -0,0 +1,58 @@
+'''
+module storage
+
+Helpers for the files the scrubber keeps around between runs.
+'''
+
+import hashlib
+import json
+import logging
+import os
+
+# The folder holding the program, which relative paths are resolved against,
+# so that the program does not depend on the current working directory
+BASE_PATH = os.path.realpath(os.path.dirname(__file__))
+
+
+def resolve_path(*parts):
+    '''
+    Joins the parts onto the program folder. An absolute path is kept as is.
+    '''
+    return os.path.join(BASE_PATH, *parts)
+
+def hash_file(filename):
+    '''
+    Returns the hex sha256 digest of the contents of the file.
+    '''
+
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as infile:
+        for block in iter(lambda: infile.read(1 << 16), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+def read_json(filename):
+    '''
+    Returns the contents of a json file, or None if it does not exist or is
+    not valid json.
+    '''
+
+    try:
+        with open(filename) as json_file:
+            return json.load(json_file)
+    except (OSError, ValueError):
+        logging.debug('Could not read {}'.format(filename))
+        return None
+
+def write_json(filename, data, indent=1):
+    '''
+    Writes the data to a json file. The data goes to a temporary file first,
+    which then takes the place of the file, so an interrupted write never
+    leaves the file half written.
+    '''
+
+    tmpfilename = filename + '.tmp'
+    with open(tmpfilename, 'w') as json_file:
+        json.dump(data, json_file, indent=indent, sort_keys=True)
+    os.replace(tmpfilename, filename)
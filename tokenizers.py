@@ -0,0 +1,264 @@
+'''
+module tokenizers
+
+The event sources that turn the raw html into the handle_starttag,
+handle_endtag, and handle_data calls the parsers are written against. An event
+source has feed(data), close(), and getpos() like an HTMLParser, and calls the
+handlers of the parser it was created for.
+
+Two backends are available:
+
+    stdlib   the html.parser module itself. The parsers are HTMLParsers, so
+             they are their own event source.
+    scanner  a regular expression scanner for the plain markup of the Math
+             Emporium pages. Anything it does not know (script and style
+             contents, processing instructions, odd attribute syntax, ...) is
+             handed to html.parser until that construct is over, so both
+             backends produce the same events.
+
+Comments and declarations are dropped, since none of the parsers use them.
+'''
+
+from html import unescape
+from html.parser import HTMLParser
+import re
+import string
+
+DEFAULT_TOKENIZER = 'scanner'
+
+# The whole of a well formed start tag, with its attributes
+STARTTAG = re.compile(r'''
+    <([a-zA-Z][^\t\n\r\f />\x00]*)
+    ((?:\s+[^\s/>=][^\s/=>]*(?:\s*=\s*(?:"[^"]*"|'[^']*'|[^\s"'=<>`]+))?)*)
+    \s*(/?)>''', re.VERBOSE)
+ATTRIBUTE = re.compile(r'''
+    \s+([^\s/>=][^\s/=>]*)(?:\s*=\s*("[^"]*"|'[^']*'|[^\s"'=<>`]+))?''',
+    re.VERBOSE)
+ENDTAG = re.compile(r'</([a-zA-Z][-.a-zA-Z0-9:_]*)\s*>')
+COMMENT_CLOSE = re.compile(r'--\s*>')
+CHARREF_END = re.compile(r'[\s;]')
+
+# Their contents are not markup, so they are left to html.parser
+CDATA_CONTENT_ELEMENTS = ('script', 'style')
+
+
+class ScannerTokenizer():
+    '''
+    Scans the fed text for the tags and text of plain html, buffering an
+    incomplete tag until the rest of it is fed. The text between tags is
+    passed on in the same chunks, and with the same character references
+    converted, as html.parser does.
+    '''
+
+    def __init__(self, handler):
+        self._handle_starttag = handler.handle_starttag
+        self._handle_startendtag = handler.handle_startendtag
+        self._handle_endtag = handler.handle_endtag
+        self._handle_data = handler.handle_data
+        self._handler = handler
+        self._fallback = None
+
+        # The unprocessed text, the position of its start, and where in it the
+        # current token starts
+        self._rawdata = ''
+        self._lineno = 1
+        self._offset = 0
+        self._token = 0
+
+    def feed(self, data):
+        if not self._fallback is None:
+            self._fallback.feed(data)
+            self.resume()
+            return
+
+        rawdata = self._rawdata = self._rawdata + data
+        handle_data = self._handle_data
+        i = 0
+        n = len(rawdata)
+        while i < n:
+            j = rawdata.find('<', i)
+            if j < 0:
+                # Hold back text ending in what may be half a character
+                # reference, like html.parser
+                amppos = rawdata.rfind('&', max(i, n - 34))
+                if amppos >= 0 and not CHARREF_END.search(rawdata, amppos):
+                    break
+                j = n
+            if i < j:
+                self._token = i
+                handle_data(unescape(rawdata[i:j]))
+                i = j
+                if i == n:
+                    break
+
+            self._token = i
+            match = STARTTAG.match(rawdata, i)
+            if not match is None:
+                tag = match.group(1).lower()
+                if tag in CDATA_CONTENT_ELEMENTS:
+                    return self.hand_over(rawdata, i)
+
+                attrs = []
+                if match.group(2):
+                    for name, value in ATTRIBUTE.findall(match.group(2)):
+                        if not value:
+                            value = None
+                        elif value[0] in '"\'':
+                            value = unescape(value[1:-1])
+                        else:
+                            value = unescape(value)
+                        attrs.append((name.lower(), value))
+
+                if match.group(3):
+                    self._handle_startendtag(tag, attrs)
+                else:
+                    self._handle_starttag(tag, attrs)
+                i = match.end()
+                continue
+
+            match = ENDTAG.match(rawdata, i)
+            if not match is None:
+                self._handle_endtag(match.group(1).lower())
+                i = match.end()
+                continue
+
+            if rawdata.startswith('<!--', i):
+                match = COMMENT_CLOSE.search(rawdata, i + 4)
+                if match is None:
+                    break
+                i = match.end()
+                continue
+
+            if rawdata[i:i + 9].lower() == '<!doctype':
+                end = rawdata.find('>', i + 9)
+                if end < 0:
+                    break
+                i = end + 1
+                continue
+
+            following = rawdata[i + 1:i + 2]
+            if following and not following in string.ascii_letters and \
+                    not following in '/!?':
+                # Just a less than sign in the text
+                handle_data('<')
+                i += 1
+                continue
+
+            if rawdata.find('>', i) < 0:
+                # Most likely a tag continued on the next line
+                break
+
+            return self.hand_over(rawdata, i)
+
+        self.consume(rawdata, i)
+
+    def consume(self, rawdata, i):
+        '''
+        Drops the processed text, keeping the position of the rest.
+        '''
+        newlines = rawdata.count('\n', 0, i)
+        if newlines:
+            self._lineno += newlines
+            self._offset = i - (rawdata.rindex('\n', 0, i) + 1)
+        else:
+            self._offset += i
+        self._rawdata = rawdata[i:]
+        self._token = 0
+
+    def hand_over(self, rawdata, i):
+        '''
+        Lets html.parser take the text from i on, until it has nothing left
+        buffered.
+        '''
+        self.consume(rawdata, i)
+        fallback = _ForwardingParser(self._handler)
+        fallback.lineno, fallback.offset = self._lineno, self._offset
+        self._fallback = fallback
+
+        rawdata, self._rawdata = self._rawdata, ''
+        fallback.feed(rawdata)
+        self.resume()
+
+    def resume(self):
+        fallback = self._fallback
+        if not fallback.rawdata and fallback.cdata_elem is None:
+            self._lineno, self._offset = fallback.getpos()
+            self._token = 0
+            self._fallback = None
+
+    def close(self):
+        if self._fallback is None and self._rawdata:
+            self.hand_over(self._rawdata, 0)
+        if not self._fallback is None:
+            self._fallback.close()
+            self._fallback = None
+
+    def getpos(self):
+        '''
+        Returns the line number and offset at which the current event starts.
+        '''
+        if not self._fallback is None:
+            return self._fallback.getpos()
+
+        rawdata = self._rawdata
+        newlines = rawdata.count('\n', 0, self._token)
+        if newlines:
+            return (self._lineno + newlines,
+                self._token - (rawdata.rindex('\n', 0, self._token) + 1))
+        return self._lineno, self._offset + self._token
+
+    def __repr__(self):
+        return 'ScannerTokenizer({})'.format(type(self._handler).__name__)
+
+
+class AlteredTokenizer(ScannerTokenizer):
+    '''
+    A backend that differs on purpose, turning all text to upper case. It is
+    never registered, but lets a comparison of the backends check that it
+    would report a difference at all.
+    '''
+
+    def __init__(self, handler):
+        super(AlteredTokenizer, self).__init__(handler)
+        handle_data = self._handle_data
+        self._handle_data = lambda data: handle_data(data.upper())
+
+
+class _ForwardingParser(HTMLParser):
+    '''
+    An html.parser passing its events on to another handler.
+    '''
+
+    def __init__(self, handler):
+        super(_ForwardingParser, self).__init__()
+        self.handle_starttag = handler.handle_starttag
+        self.handle_startendtag = handler.handle_startendtag
+        self.handle_endtag = handler.handle_endtag
+        self.handle_data = handler.handle_data
+
+
+TOKENIZERS = {
+    'scanner': ScannerTokenizer
+}
+
+def tokenizer_names():
+    return ['stdlib'] + sorted(TOKENIZERS)
+
+def tokenizer_name(config):
+    '''
+    Returns the backend selected by the config.
+    '''
+    name = config['DEFAULT'].get('tokenizer', DEFAULT_TOKENIZER)
+    if not name in TOKENIZERS and name != 'stdlib':
+        raise ValueError('Unknown tokenizer "{}", expected one of {}'.format(
+            name, ', '.join(tokenizer_names())))
+    return name
+
+def event_source(handler, name=DEFAULT_TOKENIZER):
+    '''
+    Returns the event source feeding the handler (an HTMLParser) with the
+    named backend.
+    '''
+    if name == 'stdlib':
+        return handler
+    return TOKENIZERS[name](handler)
@@ -0,0 +1,110 @@
+'''
+module tracing
+
+Structured tracing of the parsers for post-mortem debugging. While tracing is
+enabled, the parsers record typed events (a tag started, a problem field got
+data, ...) into a bounded ring buffer, keeping only the most recent ones. The
+events are stored as plain tuples and only formatted when dumped, on an error
+or on demand. While disabled, recording an event costs a check against None.
+'''
+
+import collections
+import logging
+import threading
+import time
+
+DEFAULT_CAPACITY = 2000
+
+# Event kinds
+START_TAG = 'start'
+END_TAG = 'end'
+DATA = 'data'
+SKIPPED_TAG = 'skipped'
+FIELD = 'field'
+FINALIZE = 'finalize'
+NOTE = 'note'
+
+# How much of the data of an event is kept
+DATA_PREVIEW = 60
+
+# The enabled tracer, if any
+tracer = None
+_tracer_lock = threading.Lock()
+
+Event = collections.namedtuple('Event', ['time', 'kind', 'source', 'detail'])
+
+
+class Tracer():
+    '''
+    Keeps the last capacity events recorded. Appending to the deque is atomic,
+    so the parsers of several threads may record into the same tracer.
+    '''
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self._events = collections.deque(maxlen=capacity)
+        self._start = time.perf_counter()
+        self.recorded = 0
+
+    def record(self, kind, source, *detail):
+        self._events.append((time.perf_counter(), kind, source, detail))
+        self.recorded += 1
+
+    def events(self):
+        return [Event(event_time - self._start, kind, source, detail)
+            for event_time, kind, source, detail in list(self._events)]
+
+    def clear(self):
+        self._events.clear()
+        self.recorded = 0
+
+    def format(self):
+        '''
+        Returns the buffered events, oldest first, one per line.
+        '''
+        lines = []
+        dropped = self.recorded - len(self._events)
+        if dropped > 0:
+            lines.append('... {} earlier events dropped'.format(dropped))
+        for event in self.events():
+            lines.append('{:>10.6f} {:<9} {:<22} {}'.format(event.time,
+                event.kind, event.source, ' '.join(map(str, event.detail))))
+        return '\n'.join(lines)
+
+    def dump(self, filename=None):
+        '''
+        Writes the buffered events to the file, or logs them if no file is
+        given.
+        '''
+        if filename is None:
+            logging.info('Trace of the last {} events:\n{}'.format(
+                len(self._events), self.format()))
+        else:
+            with open(filename, 'w') as trace_file:
+                trace_file.write(self.format() + '\n')
+
+    def __repr__(self):
+        return 'Tracer({} of {} events)'.format(len(self._events), self.capacity)
+
+
+def enable(capacity=DEFAULT_CAPACITY):
+    '''
+    Starts tracing the parsers created from now on, returning the tracer.
+    '''
+    global tracer
+    with _tracer_lock:
+        tracer = Tracer(capacity)
+    return tracer
+
+def disable():
+    global tracer
+    with _tracer_lock:
+        tracer = None
+
+def preview(data):
+    '''
+    Shortens the data of an event to something worth keeping around.
+    '''
+    if len(data) > DATA_PREVIEW:
+        data = data[:DATA_PREVIEW] + '...'
+    return repr(data)
@@ -0,0 +1,243 @@
+'''
+module transcriptions
+
+Contains the persistent store of image transcriptions, so that an image only
+ever needs to be typeset once, no matter how many pages or runs it appears in,
+along with the queue of images deferred to a later transcription session.
+'''
+
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+
+from storage import hash_file, read_json, resolve_path, write_json
+
+DEFAULT_TRANSCRIPTION_FILENAME = 'transcriptions.json'
+
+# Deferred images are written to the outputs as [[image:<key>]]
+PLACEHOLDER_FORMAT = '[[image:{}]]'
+PLACEHOLDER_PATTERN = re.compile(r'\[\[image:([^\]]+)\]\]')
+
+
+class TranscriptionStore():
+    '''
+    Maps images to the text typed in for them. Images are keyed by the hash of
+    their contents, so the same equation saved under different names is only
+    typeset once. When the image file cannot be read, the raw path (the src
+    attribute) is used as a fallback key. Every new transcription is saved
+    immediately, so nothing is lost if the program aborts.
+    '''
+
+    # Stores already loaded in this process, by filename
+    _open_stores = {}
+    _open_lock = threading.Lock()
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._mtime = None
+        self._hashes = {}
+        self._paths = {}
+        self.reload()
+
+    @classmethod
+    def open(cls, filename):
+        '''
+        Returns the store for the file, sharing it with every other parser in
+        the process. The store is reloaded if the file changed on disk.
+        '''
+        with cls._open_lock:
+            store = cls._open_stores.get(filename)
+            if store is None:
+                store = cls._open_stores[filename] = cls(filename)
+            elif store._mtime != store.current_mtime():
+                store.reload()
+
+        return store
+
+    @classmethod
+    def from_config(cls, config):
+        filename = config['DEFAULT'].get('transcription_file',
+            DEFAULT_TRANSCRIPTION_FILENAME)
+        return cls.open(resolve_path(filename))
+
+    def current_mtime(self):
+        try:
+            return os.path.getmtime(self._filename)
+        except OSError:
+            return None
+
+    def reload(self):
+        self._mtime = self.current_mtime()
+        contents = read_json(self._filename) or {}
+        self._hashes = contents.get('hashes', {})
+        self._paths = contents.get('paths', {})
+        logging.debug('Loaded {} image transcriptions from {}'.format(
+            len(self._hashes) + len(self._paths), self._filename))
+
+    def lookup(self, src):
+        '''
+        Returns the stored text for the image, or None if it was never
+        transcribed.
+        '''
+        digest = image_hash(src)
+        if not digest is None and digest in self._hashes:
+            return self._hashes[digest]
+
+        return self._paths.get(src)
+
+    def store(self, src, text):
+        digest = image_hash(src)
+        if digest is None:
+            self._paths[src] = text
+        else:
+            self._hashes[digest] = text
+        self.save()
+
+    def save(self):
+        write_json(self._filename, {'hashes': self._hashes, 'paths': self._paths})
+        self._mtime = self.current_mtime()
+
+    def __len__(self):
+        return len(self._hashes) + len(self._paths)
+
+    def __repr__(self):
+        return 'TranscriptionStore({})'.format(self._filename)
+
+
+def image_path(src):
+    return resolve_path('raw', src)
+
+def image_hash(src):
+    '''
+    Returns the hash of the image referenced by src, or None if the image
+    cannot be read.
+    '''
+    try:
+        return hash_file(image_path(src))
+    except OSError:
+        return None
+
+def image_key(src):
+    '''
+    Returns a stable key for the image, which is the hash of the image or, if
+    it cannot be read, its src.
+    '''
+    digest = image_hash(src)
+    return src if digest is None else digest
+
+def placeholder(key):
+    return PLACEHOLDER_FORMAT.format(key)
+
+def prompt_image_text(imgpath, config):
+    '''
+    Shows the image to the user and returns the text they typed in for it.
+    '''
+    # Show the image using config command
+    img_show_command = config['DEFAULT']['image_command']
+    img_show_command = img_show_command.format(imgpath)
+    os.system(img_show_command)
+
+    # Ask the user for the text. Do this by create a file that
+    # the user can modify with the specified text editor in the
+    # config.
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # Name of the file will be the image basename
+        filename = os.path.basename(imgpath)
+        filename = os.path.splitext(filename)[0]
+        filename += '.tex'
+        filename = os.path.join(tmpdir, filename)
+        open(filename, 'a').close() # Just make the file
+
+        text_edit_command = config['DEFAULT']['text_edit_command']
+        text_edit_command = text_edit_command.format(filename)
+        os.system(text_edit_command)
+
+        with open(filename) as tmpfile:
+            content = tmpfile.read().rstrip()
+            if content == config['DEFAULT']['abort_text']:
+                raise Exception('Abort text encountered while handling image')
+        # Closes file
+    # Removes temporary directory
+
+    return content
+
+def queue_images(queuefilename, outputfilename, deferred_images):
+    '''
+    Adds the deferred images of an output file to the queue. Each image is one
+    json line, appended in a single write so that pages scrubbed in parallel do
+    not interleave.
+    '''
+    if not deferred_images:
+        return
+
+    lines = [json.dumps({'key': key, 'src': src, 'output': outputfilename}) + '\n'
+        for key, src in deferred_images]
+    with open(queuefilename, 'a') as queuefile:
+        queuefile.write(''.join(lines))
+
+def transcribe_queue(queuefilename, config):
+    '''
+    Works through the queue of deferred images, asking for each distinct image
+    only once (and not at all if it was transcribed since), then replaces the
+    placeholders in every queued output. If the session is aborted, the
+    outputs and queue are left alone, but every text typed in so far is kept
+    in the store. Returns the number of images typeset.
+    '''
+    try:
+        with open(queuefilename) as queuefile:
+            entries = [json.loads(line) for line in queuefile if line.strip()]
+    except OSError:
+        entries = []
+
+    sources = {}
+    outputs = []
+    for entry in entries:
+        sources.setdefault(entry['key'], entry['src'])
+        if not entry['output'] in outputs:
+            outputs.append(entry['output'])
+
+    logging.info('{} images queued ({} distinct) across {} outputs'.format(
+        len(entries), len(sources), len(outputs)))
+
+    store = TranscriptionStore.from_config(config)
+    texts = {}
+    typeset = 0
+    for key, src in sources.items():
+        content = store.lookup(src)
+        if content is None:
+            logging.info('Handling image {}'.format(src))
+            content = prompt_image_text(image_path(src), config)
+            if content:
+                store.store(src, content)
+                typeset += 1
+
+        texts[key] = content or config['DEFAULT']['default_image_text']
+
+    for outputfilename in outputs:
+        patch_placeholders(outputfilename, texts)
+
+    if entries:
+        os.remove(queuefilename)
+    return typeset
+
+def patch_placeholders(outputfilename, texts):
+    '''
+    Replaces the placeholders of the given image keys in the output file.
+    Placeholders of other images are left in place.
+    '''
+    try:
+        with open(outputfilename) as outfile:
+            contents = outfile.read()
+    except OSError:
+        logging.warning('Queued output {} no longer exists'.format(outputfilename))
+        return
+
+    replace = lambda match: texts.get(match.group(1), match.group(0))
+    patched = PLACEHOLDER_PATTERN.sub(replace, contents)
+    if patched != contents:
+        logging.info('Patching images in {}'.format(outputfilename))
+        with open(outputfilename, 'w') as outfile:
+            outfile.write(patched)
@@ -0,0 +1,121 @@
+'''
+module watch
+
+Watches the raw pages and the files they are converted with (config,
+template, transcriptions) for changes, so a long running scrubber can redo
+just the pages that changed. The files are polled, unless the optional
+inotify_simple package is installed, in which case the scan only runs when
+the kernel reports a change in one of the watched folders. Either way, a
+burst of changes (an editor saving several files, or writing one in pieces)
+is only reported once it settles.
+'''
+
+import os
+import time
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+DEFAULT_INTERVAL = 0.5
+
+# Changes are reported once nothing changed for this many seconds
+DEFAULT_DEBOUNCE = 0.2
+
+
+class Watcher():
+    '''
+    Calls list_pages for the {page: filename} of the pages to watch, and
+    list_files for the other files, whenever it scans. Each call to wait
+    blocks until something changed, then returns the changed (or new) pages
+    and the changed files.
+    '''
+
+    def __init__(self, list_pages, list_files, interval=DEFAULT_INTERVAL,
+            debounce=DEFAULT_DEBOUNCE):
+        self._list_pages = list_pages
+        self._list_files = list_files
+        self.interval = interval
+        self.debounce = debounce
+
+        self._inotify = None
+        if not inotify_simple is None:
+            self._inotify = inotify_simple.INotify()
+        self._watched_folders = set()
+
+        self._pages, self._files = self.scan()
+
+    def scan(self):
+        page_files = self._list_pages()
+        pages = {page: file_state(filename)
+            for page, filename in page_files.items()}
+        files = {filename: file_state(filename) for filename in self._list_files()}
+
+        if not self._inotify is None:
+            self.watch_folders(list(page_files.values()) + list(files))
+        return pages, files
+
+    def watch_folders(self, filenames):
+        flags = inotify_simple.flags
+        mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE | flags.DELETE
+        for folder in {os.path.dirname(filename) for filename in filenames}:
+            if not folder in self._watched_folders and os.path.isdir(folder):
+                self._inotify.add_watch(folder, mask)
+                self._watched_folders.add(folder)
+
+    def changes(self):
+        '''
+        Scans again, returning the pages and files that changed since the last
+        scan.
+        '''
+        pages, files = self.scan()
+        changed_pages = [page for page, state in pages.items()
+            if self._pages.get(page) != state and not state is None]
+        changed_files = [filename for filename, state in files.items()
+            if self._files.get(filename) != state]
+        self._pages, self._files = pages, files
+        return changed_pages, changed_files
+
+    def sleep(self, seconds):
+        '''
+        Waits for the given time, or less if inotify reports a change first.
+        '''
+        if self._inotify is None:
+            time.sleep(seconds)
+        else:
+            self._inotify.read(timeout=int(seconds * 1000))
+
+    def wait(self):
+        changed_pages, changed_files = set(), set()
+        while not (changed_pages or changed_files):
+            self.sleep(self.interval)
+            pages, files = self.changes()
+            changed_pages.update(pages)
+            changed_files.update(files)
+
+        # Let the burst settle
+        while True:
+            time.sleep(self.debounce)
+            pages, files = self.changes()
+            if not (pages or files):
+                break
+            changed_pages.update(pages)
+            changed_files.update(files)
+
+        return sorted(changed_pages), sorted(changed_files)
+
+    def __repr__(self):
+        return 'Watcher({} pages, {} files, {})'.format(len(self._pages),
+            len(self._files), 'polling' if self._inotify is None else 'inotify')
+
+
+def file_state(filename):
+    '''
+    Returns what identifies the version of a file, or None if it is missing.
+    '''
+    try:
+        status = os.stat(filename)
+    except OSError:
+        return None
+    return (status.st_mtime_ns, status.st_size)